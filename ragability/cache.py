@@ -0,0 +1,92 @@
+"""
+Module for caching the responses of the LLMs, so that identical queries do not have to be sent to the LLM again.
+"""
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Optional, List, Dict
+
+class ResponseCache:
+    """
+    Cache of LLM responses, keyed by the LLM and the exact messages sent to it, so a response is only reused for
+    identical messages.
+    If a cache file is given, the responses are also stored in that sqlite database, so that they can be reused
+    in later runs. The cache can be used from several threads at the same time.
+    """
+
+    def __init__(self, cachefile: Optional[str] = None):
+        """
+        Create the cache.
+
+        :param cachefile: if not None, the sqlite file to read cached responses from and store new responses in,
+            the file is created if it does not exist
+        """
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if cachefile:
+            # the connection is only ever used while holding the lock, so it can be shared between threads
+            self._db = sqlite3.connect(cachefile, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT, cost REAL)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(llmname: str, messages: List[Dict], model: str = "") -> str:
+        """
+        Create the cache key for the messages sent to the LLM.
+
+        :param llmname: the name of the LLM
+        :param messages: the list of message dicts with the role and content of each message
+        :param model: the model used by the LLM, so that responses are not reused if the same name is configured
+            for a different model
+        :return: the key
+        """
+        data = json.dumps([llmname, model, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the cached response for the key.
+
+        :param key: the key created with make_key
+        :return: the cached response or None if there is none
+        """
+        with self._lock:
+            answer = self._data.get(key)
+            if answer is None and self._db is not None:
+                row = self._db.execute("SELECT answer FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    answer = self._data[key] = row[0]
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def put(self, key: str, answer: str, cost: float = 0.0):
+        """
+        Store the response for the key.
+
+        :param key: the key created with make_key
+        :param answer: the response of the LLM
+        :param cost: the cost of the query, only stored in the cache file for information
+        """
+        with self._lock:
+            self._data[key] = answer
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, answer, cost) VALUES (?, ?, ?)",
+                                 (key, answer, cost))
+                self._db.commit()
+
+    def close(self):
+        """
+        Close the cache file, if there is one.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
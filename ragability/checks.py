@@ -3,10 +3,41 @@ This module defines the checking functions that are implemented for testing the
 The module defines the functions, and registers them in the CHECKS dictionary which contains, for each function
 name, the function definition, the kind of check (e.g. binary, multiclass, score), the default target,
 and the number of arguments required in addition to the answer text itself.
+
+For some of the checks, a batched variant is registered in the BATCH_CHECKS dictionary under the same name. A batched
+variant gets a pandas Series of answer texts instead of a single answer text and the same additional arguments, and
+returns a Series of results, evaluating the check for all answers with vectorized pandas string operations.
+ragability_check uses the batched variant for large groups of checks with the same function and arguments.
 """
 import re
+import functools
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 CHECKS = {}
+BATCH_CHECKS = {}
+
+# pattern used by extract_score to find all the numbers in an answer
+_NUMBER_RE = re.compile(r'-?\d+\.?\d*')
+
+# the normalized answer texts recognized by the affirmative, negative and unknown checks
+_AFFIRMATIVE_SET = frozenset({"yes", "true", "positive"})
+_NEGATIVE_SET = frozenset({"no", "false", "negative"})
+_UNKNOWN_SET = frozenset({"unknown", "uncertain", "i do not know", "i don't know"})
+
+# map each normalized answer text to the class of answer it represents, this is used by the affirmative,
+# negative and unknown checks so that all of them can share a single lookup per answer
+_ANSWER_CLASSES = {
+    **dict.fromkeys(_AFFIRMATIVE_SET, "affirmative"),
+    **dict.fromkeys(_NEGATIVE_SET, "negative"),
+    **dict.fromkeys(_UNKNOWN_SET, "unknown"),
+}
+
+# the minimum number of targets for which contains_oneof and contains_all use an Aho-Corasick automaton (if the
+# pyahocorasick package is installed), for fewer targets searching for each target separately is faster
+_AUTOMATON_MIN_TARGETS = 8
 
 
 def register_check(name: str, kind: str, nargs: int, target: str = "", description: str = ""):
@@ -31,6 +62,40 @@ def register_check(name: str, kind: str, nargs: int, target: str = "", descripti
     return decorator
 
 
+def register_batch_check(name: str):
+    """
+    Register a batched variant of the check function with the given name in the BATCH_CHECKS dictionary.
+    The batched variant must take the same positional and keyword arguments as the check function, except that
+    the first argument is a pandas Series of answer texts, and must return a Series of the results.
+    :param name: the name of the check function
+    """
+    def decorator(func):
+        if name not in CHECKS:
+            raise ValueError(f"Error: Cannot register batched variant for unknown check function {name}")
+        BATCH_CHECKS[name] = func
+        return func
+    return decorator
+
+
+def _batch_result(mask):
+    """
+    Convert a boolean Series to a Series of "1" and "0" results, missing values are treated as False
+    """
+    return mask.fillna(False).astype(bool).map({True: "1", False: "0"})
+
+
+@functools.lru_cache(maxsize=4096)
+def _norm(text):
+    """
+    Normalize the text for comparisons which ignore case and surrounding whitespace. We use casefold instead of
+    lower, so that caseless comparison also works for non-ASCII text. The result is cached, so running several
+    checks on the same answer, or the same check with the same target, only normalizes each text once.
+    :param text: the text to normalize
+    :return: the normalized text
+    """
+    return text.strip().casefold()
+
+
 @register_check("is_eq", "binary", 1,
                 target="1",
                 description="Check if the answer is exactly the target")
@@ -54,7 +119,7 @@ def is_textual_eq(answer, target):
     :param target: the target text
     :return: 1 if the answer is equal to the target, ignoring case and whitespace, 0 otherwise
     """
-    return "1" if answer.strip().lower() == target.strip().lower() else "0"
+    return "1" if _norm(answer) == _norm(target) else "0"
 
 
 @register_check("contains", "binary", 1,
@@ -70,6 +135,48 @@ def contains(answer, target):
     return "1" if target in answer else "0"
 
 
+def _classify(answer):
+    """
+    Classify the answer as "affirmative", "negative" or "unknown", ignoring case and whitespace.
+    Since the normalized answer is cached, running several of the classifying checks on the same answer only
+    normalizes the answer once.
+    :param answer: the answer text
+    :return: the name of the class or None if the answer does not belong to any class
+    """
+    return _ANSWER_CLASSES.get(_norm(answer))
+
+
+@functools.lru_cache(maxsize=1024)
+def _norm_targets(targets):
+    """
+    Return the set of targets with case and surrounding whitespace removed. The result is cached, so the targets
+    of a check are only normalized once, even if the check is run on many answers.
+    :param targets: a tuple of target texts
+    :return: a frozenset of the normalized target texts
+    """
+    return frozenset(_norm(t) for t in targets)
+
+
+@functools.lru_cache(maxsize=1024)
+def _make_automaton(targets):
+    """
+    Build an Aho-Corasick automaton which finds all occurrences of any of the (non-empty) targets in a single
+    pass over a text. The value stored for each target is the target itself. The result is cached, so the
+    automaton for the targets of a check is only built once.
+    :param targets: a tuple of target texts
+    :return: the automaton or None if the pyahocorasick package is not available or there are too few
+        targets for the automaton to be faster than searching for each target in turn
+    """
+    if ahocorasick is None or len(targets) < _AUTOMATON_MIN_TARGETS:
+        return None
+    automaton = ahocorasick.Automaton()
+    for t in targets:
+        if t:
+            automaton.add_word(t, t)
+    automaton.make_automaton()
+    return automaton
+
+
 @register_check("affirmative", "binary", 0,
                 target="1",
                 description="Check if the answer is affirmative (yes, true, positive)")
@@ -79,7 +186,7 @@ def affirmative(answer):
     :param answer: the answer text
     :return: 1 if the answer is affirmative, 0 otherwise
     """
-    return "1" if answer.strip().lower() in ["yes", "true", "positive"] else "0"
+    return "1" if _classify(answer) == "affirmative" else "0"
 
 
 @register_check("negative", "binary", 0,
@@ -91,7 +198,7 @@ def negative(answer):
     :param answer: the answer text
     :return: 1 if the answer is negative, 0 otherwise
     """
-    return "1" if answer.strip().lower() in ["no", "false", "negative"] else "0"
+    return "1" if _classify(answer) == "negative" else "0"
 
 
 @register_check("unknown", "binary", 0,
@@ -103,7 +210,7 @@ def unknown(answer):
     :param answer: the answer text
     :return: 1 if the answer is unknown, 0 otherwise
     """
-    return "1" if answer.strip().lower() in ["unknown", "uncertain", "i do not know", "i don't know"] else "0"
+    return "1" if _classify(answer) == "unknown" else "0"
 
 
 @register_check("is_eq_oneof", "binary", 1,
@@ -127,7 +234,7 @@ def is_textual_eq_oneof(answer, targets):
     :param targets: a list of target texts
     :return: 1 if the answer is equal to one of the targets, 0 otherwise
     """
-    return "1" if answer.strip().lower() in [t.strip().lower() for t in targets] else "0"
+    return "1" if _norm(answer) in _norm_targets(tuple(targets)) else "0"
 
 
 @register_check("contains_oneof", "binary", 1,
@@ -139,7 +246,15 @@ def contains_oneof(answer, targets):
     :param targets: a list of target texts
     :return: 1 if the answer contains one of the targets, 0 otherwise
     """
-    return "1" if any(t in answer for t in targets) else "0"
+    automaton = _make_automaton(tuple(targets))
+    if automaton is None:
+        return "1" if any(t in answer for t in targets) else "0"
+    # the empty string is contained in every answer but cannot be added to the automaton
+    if "" in targets:
+        return "1"
+    for _ in automaton.iter(answer):
+        return "1"
+    return "0"
 
 
 @register_check("contains_all", "binary", 1,
@@ -151,7 +266,17 @@ def contains_all(answer, targets):
     :param targets: a list of target texts
     :return: 1 if the answer contains all of the targets, 0 otherwise
     """
-    return "1" if all(t in answer for t in targets) else "0"
+    automaton = _make_automaton(tuple(targets))
+    if automaton is None:
+        return "1" if all(t in answer for t in targets) else "0"
+    # the empty string is contained in every answer and is not part of the automaton, so we only need to
+    # find all the distinct non-empty targets
+    missing = {t for t in targets if t}
+    for _, t in automaton.iter(answer):
+        missing.discard(t)
+        if not missing:
+            return "1"
+    return "1" if not missing else "0"
 
 @register_check("extract_score", "score", 0,
                 description="Extract a score from the answer. Expext exactly one number in the answer,if more raise exception")
@@ -161,7 +286,89 @@ def extract_score(answer):
     :param answer: the answer text
     :return: the score
     """
-    numbers = [float(s) for s in re.findall(r'-?\d+\.?\d*', answer)]
+    numbers = [float(s) for s in _NUMBER_RE.findall(answer)]
     if len(numbers) != 1:
         raise Exception(f"Error: Expected exactly one number in the answer, got {len(numbers)}")
     return numbers[0]
+
+
+@register_batch_check("is_eq")
+def batch_is_eq(answers, target):
+    """
+    Batched variant of is_eq
+    :param answers: a Series of answer texts
+    :param target: the target text
+    :return: a Series with 1 where the answer is exactly the target, 0 otherwise
+    """
+    return _batch_result(answers == target)
+
+
+@register_batch_check("is_textual_eq")
+def batch_is_textual_eq(answers, target):
+    """
+    Batched variant of is_textual_eq
+    :param answers: a Series of answer texts
+    :param target: the target text
+    :return: a Series with 1 where the answer is equal to the target, ignoring case and whitespace, 0 otherwise
+    """
+    return _batch_result(answers.str.strip().str.casefold() == _norm(target))
+
+
+@register_batch_check("contains")
+def batch_contains(answers, target):
+    """
+    Batched variant of contains
+    :param answers: a Series of answer texts
+    :param target: the target text
+    :return: a Series with 1 where the answer contains the target, 0 otherwise
+    """
+    return _batch_result(answers.str.contains(target, regex=False))
+
+
+@register_batch_check("is_eq_oneof")
+def batch_is_eq_oneof(answers, targets):
+    """
+    Batched variant of is_eq_oneof
+    :param answers: a Series of answer texts
+    :param targets: a list of target texts
+    :return: a Series with 1 where the answer is exactly one of the targets, 0 otherwise
+    """
+    return _batch_result(answers.isin(targets))
+
+
+@register_batch_check("is_textual_eq_oneof")
+def batch_is_textual_eq_oneof(answers, targets):
+    """
+    Batched variant of is_textual_eq_oneof
+    :param answers: a Series of answer texts
+    :param targets: a list of target texts
+    :return: a Series with 1 where the answer is equal to one of the targets, ignoring case and whitespace, 0 otherwise
+    """
+    return _batch_result(answers.str.strip().str.casefold().isin(_norm_targets(tuple(targets))))
+
+
+@register_batch_check("contains_oneof")
+def batch_contains_oneof(answers, targets):
+    """
+    Batched variant of contains_oneof
+    :param answers: a Series of answer texts
+    :param targets: a list of target texts
+    :return: a Series with 1 where the answer contains one of the targets, 0 otherwise
+    """
+    if not targets:
+        return answers.map(lambda a: "0")
+    return _batch_result(answers.str.contains("|".join(re.escape(t) for t in targets), regex=True))
+
+
+@register_batch_check("contains_all")
+def batch_contains_all(answers, targets):
+    """
+    Batched variant of contains_all
+    :param answers: a Series of answer texts
+    :param targets: a list of target texts
+    :return: a Series with 1 where the answer contains all of the targets, 0 otherwise
+    """
+    mask = answers.notna()
+    for t in targets:
+        mask &= answers.str.contains(t, regex=False).fillna(False).astype(bool)
+    return _batch_result(mask)
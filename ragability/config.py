@@ -5,14 +5,7 @@ one of the following formats: json, hjson, yaml, toml. This module only cares ab
 
 """
 from ragability.logging import logger,  set_logging_level, add_logging_file
-import warnings
 
 
-
-## Suppress the annoying litellm warning
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    from litellm import LITELLM_CHAT_PROVIDERS
-
 # TODO: any additional ragability specific updates or checks related to the config file
 
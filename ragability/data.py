@@ -1,12 +1,64 @@
 """
 Module for functions related to reading or writing files and checking file contents.
 """
+import os
 import sys
 import json
+import pickle
+import stat
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import orjson
 import yaml
-import hjson
 from ragability.logging import logger
 
+# use the libyaml based loader if PyYAML was built with it, it is much faster than the pure Python one
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+# sentinel for fields which are missing, as opposed to fields which are present with a null value
+_MISSING = object()
+
+# number of input entries checked by each worker process when the entries are checked in parallel
+_VALIDATE_CHUNKSIZE = 1000
+
+# the maximum number of parsed input files kept in the cache directory by cached_read_input_file
+CACHE_MAXFILES = 16
+
+
+def iter_jsonl_file(input_file):
+    """
+    Read the jsonl file one line at a time and yield the dict from each non-empty line, so that the whole file
+    never has to be kept in memory.
+
+    :param input_file: file to read
+    :return: iterator over the dicts
+    """
+    with open(input_file, 'rb') as f:
+        linenr = 0
+        for line in f:
+            linenr += 1
+            # ignore empty lines
+            if not line.strip():
+                continue
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # orjson is stricter than the json module (e.g. for NaN or huge integers), so only
+                # fail if the json module cannot decode the line either
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as e:
+                    line = line.decode("utf-8", errors="replace")
+                    raise Exception(f"Error: Could not decode JSON line in file {input_file}, line {linenr}: {line}\nError: {e}")
+            if not isinstance(entry, dict):
+                raise Exception(f"Error: Entry in line {linenr} is not a dict")
+            yield entry
+
 
 def read_file(input_file):
     """
@@ -22,46 +74,44 @@ def read_file(input_file):
     """
     data = []
     if input_file.endswith(".jsonl"):
-        with open(input_file, 'r') as f:
-            linenr = 0
-            for line in f:
-                linenr += 1
-                # ignore empty lines
-                if not line.strip():
-                    continue
-                try:
-                    entry = json.loads(line)
-                except json.JSONDecodeError as e:
-                    raise Exception(f"Error: Could not decode JSON line in file {input_file}, line {linenr}: {line}\nError: {e}")
-                if not isinstance(entry, dict):
-                    raise Exception(f"Error: Entry in line {linenr} is not a dict")
-                data.append(entry)
+        data = list(iter_jsonl_file(input_file))
     elif input_file.endswith(".json"):
-        with open(input_file, 'r') as f:
+        with open(input_file, 'rb') as f:
+            content = f.read()
             try:
-                data = json.load(f)
-            except json.JSONDecodeError as e:
-                raise Exception(f"Error: Could not decode JSON file {input_file}: {e}")
+                data = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                try:
+                    data = json.loads(content)
+                except json.JSONDecodeError as e:
+                    raise Exception(f"Error: Could not decode JSON file {input_file}: {e}")
             if not isinstance(data, list):
                 raise Exception(f"Error: JSON file {input_file} does not contain an array")
             for idx, entry in enumerate(data):
                 if not isinstance(entry, dict):
                     raise Exception(f"Error: Entry {idx+1} in JSON file {input_file} is not a dict: {entry}")
     elif input_file.endswith(".hjson"):
-        with open(input_file, 'r') as f:
+        with open(input_file, 'rb') as f:
+            content = f.read()
+        # many hjson files are actually strict json, so try the much faster orjson parser first and only
+        # import and use the hjson parser if that fails
+        try:
+            data = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            import hjson
             try:
-                data = hjson.load(f)
+                data = hjson.loads(content.decode("utf-8"))
             except json.JSONDecodeError as e:
                 raise Exception(f"Error: Could not decode HJSON file {input_file}: {e}")
-            if not isinstance(data, list):
-                raise Exception(f"Error: HJSON file {input_file} does not contain an array")
-            for idx, entry in enumerate(data):
-                if not isinstance(entry, dict):
-                    raise Exception(f"Error: Entry {idx+1} in HJSON file {input_file} is not a dict: {entry}")
+        if not isinstance(data, list):
+            raise Exception(f"Error: HJSON file {input_file} does not contain an array")
+        for idx, entry in enumerate(data):
+            if not isinstance(entry, dict):
+                raise Exception(f"Error: Entry {idx+1} in HJSON file {input_file} is not a dict: {entry}")
     elif input_file.endswith(".yaml"):
         with open(input_file, 'r') as f:
             try:
-                data = yaml.safe_load(f)
+                data = yaml.load(f, Loader=YamlSafeLoader)
             except yaml.YAMLError as e:
                 raise Exception(f"Error: Could not decode YAML file {input_file}: {e}")
             if not isinstance(data, list):
@@ -73,7 +123,64 @@ def read_file(input_file):
         raise Exception(f"Error: Unknown file extension for input file {input_file}")
     return data
 
-def read_input_file(input_file):
+def _validate_entries(start, entries):
+    """
+    Check the fields and their types for the given input entries. Each field is looked up only once per
+    entry/check, the _MISSING sentinel is used to distinguish missing fields from fields which are present with
+    a null value. This does not log anything itself, so that it can also be run in a worker process, instead
+    the messages to log are returned in the order in which they occurred, up to the first error found.
+
+    :param start: the number of the first entry, used in the messages
+    :param entries: the list of entries to check
+    :return: a tuple (messages, error) where messages is a list of (level, message, nentry) tuples to log and
+        error is the error message for the first invalid entry or None if all entries are valid
+    """
+    messages = []
+    for nentry, entry in enumerate(entries, start=start):
+        # check the fields
+        if 'qid' not in entry:
+            return messages, f"Error: Missing 'qid' field in entry: {nentry}"
+        facts = entry.get('facts', _MISSING)
+        if facts is _MISSING:
+            messages.append((logging.DEBUG, "Missing 'facts' field in entry: %s", nentry))
+        elif facts is not None and not isinstance(facts, (str, list)):
+            return messages, f"Error: 'facts' field must be a string or a list of strings in entry: {nentry}"
+        query = entry.get('query', _MISSING)
+        if query is _MISSING:
+            return messages, f"Error: Missing 'query' field in entry: {nentry}"
+        checks = entry.get('checks', _MISSING)
+        if checks is _MISSING:
+            messages.append((logging.WARNING, "Missing 'checks' field in entry: %s", nentry))
+        # check the type of the fields
+        if not isinstance(query, str):
+            return messages, f"Error: 'query' field must be a string in entry: {nentry}"
+        if checks is _MISSING:
+            continue
+        if not isinstance(checks, list):
+            return messages, f"Error: 'checks' field must be a list in entry: {nentry}"
+        for check in checks:
+            if not isinstance(check, dict):
+                return messages, f"Error: Check in entry {nentry} is not a dict"
+            cquery = check.get('query', _MISSING)
+            if cquery is _MISSING:
+                messages.append((logging.DEBUG, "Missing 'query' field in check in entry: %s", nentry))
+            elif not isinstance(cquery, str):
+                return messages, f"Error: 'query' field in check must be a string in entry: {nentry}"
+            func = check.get('func', _MISSING)
+            if func is _MISSING:
+                # return messages, f"Error: Missing 'func' field in check in entry: {nentry}"
+                messages.append((logging.WARNING, "Missing 'func' field in check in entry: %s", nentry))
+            elif isinstance(func, dict):
+                if 'name' not in func:
+                    return messages, f"Error: Missing 'name' field in func in entry: {nentry}"
+                if not isinstance(func['name'], str):
+                    return messages, f"Error: 'name' field in func must be a string in entry: {nentry}"
+            elif not isinstance(func, str):
+                return messages, f"Error: 'func' field in check must be a string or dictionary in entry: {nentry}"
+    return messages, None
+
+
+def read_input_file(input_file, nworkers=1):
     """
     Read the input file into memory. Depending on the file extension, the input file is either a jsonl file
     with one json dict per line, a json/hjson file which contains the json representation of an array of dicts, or
@@ -91,52 +198,159 @@ def read_input_file(input_file):
             - OTHERFIELDS: all other fields are passed as arguments to the function
     We first read in the whole file, depending on file format, then check all the entries we got for the
     required fields and their types.
-    """
-    # check the file extension and read the file accordingly
 
-    # Now check the fields and their types:
-    nentry = 0
+    :param input_file: file to read
+    :param nworkers: if more than 1, check the entries in chunks using that many worker processes. This only
+        pays off for very large files, since the entries have to be sent to the worker processes.
+    :return: array of dicts
+    """
     data = read_file(input_file)
-    for entry in data:
-        nentry += 1
-        # check the fields
-        if 'qid' not in entry:
-            raise ValueError(f"Error: Missing 'qid' field in entry: {nentry}")
-        if 'facts' not in entry:
-            logger.debug(f"Missing 'facts' field in entry: {nentry}")
-        facts = entry.get('facts')
-        if 'query' not in entry:
-            raise ValueError(f"Error: Missing 'query' field in entry: {nentry}")
-        if 'checks' not in entry:
-            logger.warning(f"Missing 'checks' field in entry: {nentry}")
-        # check the type of the fields
-        if facts is not None and not isinstance(facts, (str, list)):
-            raise ValueError(f"Error: 'facts' field must be a string or a list of strings in entry: {nentry}")
-        if not isinstance(entry['query'], str):
-            raise ValueError(f"Error: 'query' field must be a string in entry: {nentry}")
-        if "checks" in entry:
-            if not isinstance(entry['checks'], list):
-                raise ValueError(f"Error: 'checks' field must be a list in entry: {nentry}")
-            for check in entry['checks']:
-                if not isinstance(check, dict):
-                    raise ValueError(f"Error: Check in entry {nentry} is not a dict")
-                if not 'query' in check:
-                    logger.debug(f"Missing 'query' field in check in entry: {nentry}")
-                elif not isinstance(check['query'], str):
-                    raise ValueError(f"Error: 'query' field in check must be a string in entry: {nentry}")
-                if not 'func' in check:
-                    # raise ValueError(f"Error: Missing 'func' field in check in entry: {nentry}")
-                    logger.warning(f"Missing 'func' field in check in entry: {nentry}")
-                elif not isinstance(check['func'], (str, dict)):
-                    raise ValueError(f"Error: 'func' field in check must be a string or dictionary in entry: {nentry}")
-                elif isinstance(check['func'], dict):
-                    if not 'name' in check['function']:
-                        raise ValueError(f"Error: Missing 'name' field in func in entry: {nentry}")
-                    if not isinstance(check['func']['name'], str):
-                        raise ValueError(f"Error: 'name' field in func must be a string in entry: {nentry}")
+    if nworkers > 1 and len(data) > _VALIDATE_CHUNKSIZE:
+        starts = range(0, len(data), _VALIDATE_CHUNKSIZE)
+        with ProcessPoolExecutor(max_workers=nworkers) as executor:
+            results = executor.map(
+                _validate_entries,
+                [start + 1 for start in starts],
+                [data[start:start + _VALIDATE_CHUNKSIZE] for start in starts])
+            # the results are processed in the order of the chunks, so the messages are logged in the same
+            # order and the error raised is the one for the first invalid entry, as when checking serially
+            for messages, error in results:
+                for level, msg, nentry in messages:
+                    logger.log(level, msg, nentry)
+                if error is not None:
+                    raise ValueError(error)
+    else:
+        messages, error = _validate_entries(1, data)
+        for level, msg, nentry in messages:
+            logger.log(level, msg, nentry)
+        if error is not None:
+            raise ValueError(error)
+    return data
+
+
+def get_cache_dir():
+    """
+    Return the directory in which parsed input files are cached: the ragability directory in $XDG_CACHE_HOME
+    or in ~/.cache if that is not set.
+    """
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ragability")
+
+
+def _is_private(st):
+    """
+    Check if the file or directory with the given stat result is owned by the current user and cannot be written
+    by anyone else, so that its pickled contents can be trusted.
+    """
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _prune_cache_dir(cachedir, maxfiles):
+    """
+    Remove the least recently used cache files from the cache directory, so that at most maxfiles are kept.
+    """
+    entries = []
+    for entry in os.scandir(cachedir):
+        if entry.name.endswith(".pkl"):
+            try:
+                entries.append((entry.stat().st_mtime_ns, entry.path))
+            except FileNotFoundError:
+                pass
+    entries.sort(reverse=True)
+    for _, path in entries[maxfiles:]:
+        try:
+            os.remove(path)
+            logger.debug(f"Removed old cache file {path}")
+        except FileNotFoundError:
+            pass
+
+
+def cached_read_input_file(input_file, cachedir=None, nworkers=1, maxfiles=CACHE_MAXFILES):
+    """
+    Like read_input_file, but the checked entries are also kept in a pickle file in the cache directory, so that
+    running again on the same unchanged file only has to load the pickle file. The cache file is identified by the
+    absolute path, the modification time and the size of the input file, so a changed file is read again.
+    Since loading a pickle file can run arbitrary code, the cache directory and the cache files are only used if
+    they are owned by the current user and not writable by anyone else. Only the maxfiles most recently used cache
+    files are kept. If the cache cannot be used, the input file is just read with read_input_file.
+
+    :param input_file: file to read
+    :param cachedir: the directory for the cache files, if None, the directory returned by get_cache_dir
+    :param nworkers: passed on to read_input_file
+    :param maxfiles: the maximum number of cache files to keep in the cache directory
+    :return: array of dicts
+    """
+    if cachedir is None:
+        cachedir = get_cache_dir()
+    try:
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        usable = _is_private(os.stat(cachedir))
+    except OSError as e:
+        logger.warning(f"Warning: Could not create cache directory {cachedir}, not using the cache: {e}")
+        return read_input_file(input_file, nworkers=nworkers)
+    if not usable:
+        logger.warning(f"Warning: Cache directory {cachedir} is not owned by the user or is writable by others, "
+                       f"not using the cache")
+        return read_input_file(input_file, nworkers=nworkers)
+    st = os.stat(input_file)
+    ident = f"{os.path.abspath(input_file)}\0{st.st_mtime_ns}\0{st.st_size}"
+    cachefile = os.path.join(cachedir, hashlib.blake2b(ident.encode("utf-8"), digest_size=16).hexdigest() + ".pkl")
+    try:
+        with open(cachefile, "rb") as f:
+            if not _is_private(os.fstat(f.fileno())):
+                raise Exception("the file is not owned by the user or is writable by others")
+            data = pickle.load(f)
+        # the modification time of the cache file is used to find the least recently used ones
+        os.utime(cachefile)
+        logger.debug(f"Loaded cached entries of {input_file} from {cachefile}")
+        return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Warning: Could not load cache file {cachefile}, reading {input_file}: {e}")
+    data = read_input_file(input_file, nworkers=nworkers)
+    # write to a temporary file first and then rename it, so that a cache file is never only partially written
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cachefile)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
+        logger.debug(f"Cached entries of {input_file} in {cachefile}")
+        _prune_cache_dir(cachedir, maxfiles)
+    except OSError as e:
+        logger.warning(f"Warning: Could not write cache file {cachefile}: {e}")
     return data
 
 
+def iter_input_file(input_file, validate=True, nworkers=1):
+    """
+    Iterate over the entries of the input file, see read_input_file for the supported formats and fields.
+    A jsonl file is read and checked one entry at a time, so only the current entry is kept in memory,
+    all other formats are read into memory with read_input_file first.
+
+    :param input_file: file to read
+    :param validate: if False, do not check the entries, e.g. when iterating over a file which was already checked
+    :param nworkers: passed on to read_input_file for the formats which are read into memory first
+    :return: iterator over the dicts
+    """
+    if not input_file.endswith(".jsonl"):
+        yield from (read_input_file(input_file, nworkers=nworkers) if validate else read_file(input_file))
+        return
+    for nentry, entry in enumerate(iter_jsonl_file(input_file), start=1):
+        if validate:
+            messages, error = _validate_entries(nentry, [entry])
+            for level, msg, n in messages:
+                logger.log(level, msg, n)
+            if error is not None:
+                raise ValueError(error)
+        yield entry
+
+
 def read_prompt_file(prompt_file):
     """
     Read the prompt file into memory: depending on the extension this is either a jason line file (".jsonl") with
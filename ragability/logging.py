@@ -21,7 +21,7 @@ logger.setLevel(logging.INFO)
 # create a handler to log to stderr
 handler = logging.StreamHandler(sys.stderr)
 # create a formatter to format the log messages
-formatter = logging.Formatter("{asctime} {levelname} {filename}/{funcName}:{lineno}: {message}", datefmt='%Y-%m-%d %H:%M:%S', style="{")
+formatter = logging.Formatter("%(asctime)s %(levelname)s %(filename)s/%(funcName)s:%(lineno)d: %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
 # set the formatter for the handler
 handler.setFormatter(formatter)
 # add the handler to the logger
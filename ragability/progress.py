@@ -0,0 +1,112 @@
+"""
+Module for keeping track of the finished queries of a run, so that an interrupted run can be resumed without
+querying the LLMs again for the queries which already got a response.
+"""
+import os
+from typing import Dict, Tuple
+import orjson
+from ragability.logging import logger
+
+
+class ProgressFile:
+    """
+    Progress file of a run: each finished entry is appended as one json line as soon as it is available and the
+    file is synced to disk every sync_every entries, so that at most that many entries are lost if the process
+    is killed. The entries are identified by their qid, pid and llm fields. The progress file is only written from
+    one thread.
+    """
+
+    def __init__(self, progress_file: str, sync_every: int = 64):
+        """
+        Create the progress file object, nothing is read or written yet.
+
+        :param progress_file: the path of the progress file
+        :param sync_every: the number of entries after which the file is synced to disk
+        """
+        self.progress_file = progress_file
+        self.sync_every = sync_every
+        self._f = None
+        self._n_unsynced = 0
+
+    @staticmethod
+    def make_key(entry: Dict) -> Tuple:
+        """
+        Create the key which identifies the entry.
+
+        :param entry: the output entry
+        :return: the key
+        """
+        return entry["qid"], entry["pid"], entry["llm"]
+
+    def load(self) -> Dict[Tuple, Dict]:
+        """
+        Read the entries of an earlier run from the progress file, if it exists. A last line which is incomplete
+        because the earlier run was interrupted while writing it is ignored and removed from the file, so that the
+        entries added next start on a new line.
+
+        :return: a dict mapping the key of each entry to the entry
+        """
+        done = {}
+        if not os.path.exists(self.progress_file):
+            return done
+        with open(self.progress_file, "rb") as f:
+            content = f.read()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):
+            logger.warning(f"Ignoring incomplete last line in progress file {self.progress_file}")
+            os.truncate(self.progress_file, end)
+        for line in content[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                logger.warning(f"Ignoring invalid line in progress file {self.progress_file}")
+                continue
+            done[self.make_key(entry)] = entry
+        return done
+
+    def add(self, entry: Dict):
+        """
+        Append the entry to the progress file.
+
+        :param entry: the finished output entry
+        """
+        if self._f is None:
+            self._f = open(self.progress_file, "ab")
+            # if the file was not loaded first and does not end with a complete line, start on a new line
+            if self._f.tell() > 0:
+                with open(self.progress_file, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        self._f.write(b"\n")
+        self._f.write(orjson.dumps(entry) + b"\n")
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush the progress file and sync it to disk.
+        """
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._n_unsynced = 0
+
+    def close(self):
+        """
+        Sync and close the progress file.
+        """
+        if self._f is not None:
+            self.sync()
+            self._f.close()
+            self._f = None
+
+    def remove(self):
+        """
+        Close and remove the progress file, once the run is complete and it is not needed any more.
+        """
+        self.close()
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
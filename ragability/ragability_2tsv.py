@@ -12,20 +12,26 @@ field names separated by a dot.
 """
 
 import os, sys
-from typing import List, Dict, Optional
-import json
+from typing import List, Dict, Iterable
+import functools
+import csv
 import argparse
-import pandas as pd
-from pandas.core.frame import DataFrame
-import hjson
-import sklearn as sk
-from collections import defaultdict, Counter
-from logging import DEBUG
-from ragability.logging import logger, set_logging_level, add_logging_file
-from ragability.data import read_input_file
-from ragability.utils import pp_config
-from ragability.checks import CHECKS
+from collections import defaultdict
+from ragability.logging import logger
+from ragability.data import read_input_file, iter_input_file
 
+# the top level and check fields which are converted to columns, in column order
+TOPFIELDS_SCALAR = ["qid", "tags", "query", "WikiContradict_ID", "reasoning_required_c1c2", "response", "error", "pid", "llm"]
+CHECKFIELDS = ["cid", "query", "func", "metrics", "pid", "response", "llm", "result", "error", "check_for"]
+# the column index of each of the top level fields
+TOPFIELDS_IDX = {field: idx for idx, field in enumerate(TOPFIELDS_SCALAR)}
+# the same fields as sets for membership tests, and the fields which are not reported as unknown
+TOPFIELDS_SCALAR_SET = frozenset(TOPFIELDS_SCALAR)
+CHECKFIELDS_SET = frozenset(CHECKFIELDS)
+IGNORE_TOP = frozenset(("checks", "c1xq", "c2xq", "cost", "pids", "facts"))
+IGNORE_CHECK = frozenset(("cost",))
+# the number of rows written to the tsv file with one writerows call
+TSV_BATCHSIZE = 8192
 
 
 def get_args():
@@ -43,96 +49,154 @@ def get_args():
     return args
 
 
-def max_elements(data: List[Dict], keys: List[str|int]):
+def nested_len(record: Dict, keys: List[str|int]) -> int:
     """
-    Get the maximum number of elements in the array identified by the given list of keys that lead to the
-    nested array.
+    Get the number of elements of the nested value identified by the given list of keys in the record:
+    the length of the value if it is a list, 1 if it is any other value and 0 if it does not exist.
     """
-    maxn = 0
+    val = record
+    for k in keys:
+        if isinstance(val, list):
+            val = val[k] if -len(val) <= k < len(val) else None
+        else:
+            val = val.get(k)
+        if val is None:
+            return 0
+    return len(val) if isinstance(val, list) else 1
+
+
+def max_elements_multi(data: Iterable[Dict], keylists: List[List[str|int]]) -> List[int]:
+    """
+    Get the maximum number of elements in the arrays identified by each of the given lists of keys that lead to
+    the nested arrays, in a single pass over the data. Returns the maximum numbers in the same order as the lists
+    of keys.
+    """
+    maxns = [0] * len(keylists)
     for record in data:
-        # access the nested list or ignore the record if it does not exist
-        val = record
-        for k in keys:
-            if isinstance(val, list):
-                val = val[k]
-            else:
-                val = val.get(k)
-            if val is None:
-                break
-        if val is not None:
+        for idx, keys in enumerate(keylists):
+            n = nested_len(record, keys)
+            if n > maxns[idx]:
+                maxns[idx] = n
+    return maxns
+
+
+def flatten_record(record: Dict, template: List, checkidxs: Dict[str, int]) -> List:
+    """
+    Convert the record to a row of values, in the order of the columns of the output file. Only the fields
+    actually present in the record and its check are visited and put into their column.
+    :param record: the record to convert
+    :param template: the row with all columns empty, this is copied and the values present in the record filled in
+    :param checkidxs: a dict mapping the fields of the check to their column index
+    :return: the row of values
+    """
+    row = template.copy()
+    for k, val in record.items():
+        idx = TOPFIELDS_IDX.get(k)
+        if idx is not None:
+            row[idx] = val
+    # add the facts fields, not all records have the same number of facts
+    facts = record.get("facts")
+    if facts is not None:
+        if isinstance(facts, str):
+            facts = [facts]
+        ntop = len(TOPFIELDS_SCALAR)
+        row[ntop:ntop + len(facts)] = facts
+    check = (record.get("checks") or [{}])[0]
+    for k, val in check.items():
+        idx = checkidxs.get(k)
+        if idx is not None:
             if isinstance(val, list):
-                maxn = max(maxn, len(val))
-            else:
-                maxn = max(maxn, 1)
-    return maxn
+                val = ", ".join(val)
+            row[idx] = val
+    return row
+
 
 def run(config: dict):
-    indata = read_input_file(config["input"])
-    logger.info(f"Read {len(indata)} records from {config['input']}")
+    # A jsonl file is read one record at a time in each of the passes over the data below, so that only one batch
+    # of rows has to be kept in memory, all other formats are read into memory once.
+    if config["input"].endswith(".jsonl"):
+        indata = iter_input_file(config["input"])
+        records = functools.partial(iter_input_file, config["input"], validate=False)
+    else:
+        indata = read_input_file(config["input"])
+        records = functools.partial(iter, indata)
 
     # For now we only support instances with a single element in the "checks"  field and the pid field
-    maxn_checks = max_elements(indata, ["checks"])
+    # find the maximum number of checks, pids and facts in a single pass over the data
+    maxn_checks, maxn_pids, maxn_facts = max_elements_multi(indata, [["checks"], ["checks", 0, "pids"], ["facts"]])
     if maxn_checks > 1:
         logger.error(f"Only one element in the 'checks' field is supported for now, but found {maxn_checks}")
         sys.exit(1)
-    maxn_pids = max_elements(indata, ["checks", 0, "pids"])
     if maxn_pids > 1:
         logger.error(f"Only one element in the 'pids' field is supported for now, but found {maxn_pids}")
         sys.exit(1)
-    TOPFIELDS_SCALAR = ["qid", "tags", "query", "WikiContradict_ID", "reasoning_required_c1c2", "response", "error", "pid", "llm"]
-    CHECKFIELDS = ["cid", "query", "func", "metrics", "pid", "response", "llm", "result", "error", "check_for"]
-    flatdata = []
-    # find the maximum number for "facts"
-    maxn_facts = max_elements(indata, ["facts"])
-    unknownfields = Counter()
-    for record in indata:
-        flatrecord = {}
-        for field in TOPFIELDS_SCALAR:
-            flatrecord[field] = record.get(field, "")
-        # add the facts fields, not all records have the same number of facts
-        facts = record.get("facts")
-        if facts is None:
-            facts = []
-        elif isinstance(facts, str):
-            facts = [facts]
-        for i in range(maxn_facts):
-            if i < len(facts):
-                flatrecord[f"facts_{i}"] = facts[i]
-            else:
-                flatrecord[f"facts_{i}"] = ""
-        check = record.get("checks", [{}])[0]
-        for field in CHECKFIELDS:
-            val = check.get(field, "")
-            if isinstance(val, list):
-                val = ", ".join(val)
-            flatrecord[f"check.{field}"] = val
+    # the column names are computed once, each record is converted to a list of values in the same order
+    fact_cols = [f"facts_{i}" for i in range(maxn_facts)]
+    check_cols = [f"check.{field}" for field in CHECKFIELDS]
+    header = TOPFIELDS_SCALAR + fact_cols + check_cols
+    # each row starts as a copy of a template row with all columns empty, only the values present in the record
+    # are filled in
+    template = [""] * len(header)
+    checkidxs = {field: idx for idx, field in enumerate(CHECKFIELDS, start=len(TOPFIELDS_SCALAR) + maxn_facts)}
+    # Now find all the fields which have exactly the same value in all records: for each of these fields
+    # log the name and value and do not include the field in the output. The check for each field stops at the
+    # first record with a different value. In the same pass, count the fields we do not know about.
+    nrecords = 0
+    firstrow = None
+    sameidxs = list(range(len(header)))
+    unknownfields = defaultdict(int)
+    # cache for the names under which unknown check fields are counted, so each name is only built once
+    checkkeys = {}
+    for record in records():
+        nrecords += 1
+        row = flatten_record(record, template, checkidxs)
+        if firstrow is None:
+            firstrow = row
+        elif sameidxs:
+            sameidxs = [idx for idx in sameidxs if row[idx] == firstrow[idx]]
         # check if the check dict has any fields not mentioned in CHECKFIELDS, if so, count them using the
         # name check.{unknownfieldname}
-        for k in check:
-            if k not in CHECKFIELDS:
-                if k not in ["cost"]:
-                    unknownfields[f"check.{k}"] += 1
+        for k in (record.get("checks") or [{}])[0]:
+            if k not in CHECKFIELDS_SET:
+                if k not in IGNORE_CHECK:
+                    key = checkkeys.get(k)
+                    if key is None:
+                        key = checkkeys[k] = f"check.{k}"
+                    unknownfields[key] += 1
         # also check if the top level record has any fields not mentioned in TOPFIELDS_SCALAR
         for k in record:
-            if k not in TOPFIELDS_SCALAR:
-                if k not in ["checks", "c1xq", "c2xq", "cost", "pids", "facts"]:
+            if k not in TOPFIELDS_SCALAR_SET:
+                if k not in IGNORE_TOP:
                     unknownfields[k] += 1
-        flatdata.append(flatrecord)
-    # convert to a data frame
-    df = pd.DataFrame(flatdata)
-    # Now find all the fields in flatdata which all have exactly the same value: for each of these fields
-    # log the name and value and remove the field from the dataframe
-    for col in df.columns:
-        if len(df[col].unique()) == 1:
-            logger.info(f"Field {col} has the same value in all records: >>{df[col].iloc[0]}<<")
-            if not config["all"]:
-                df.drop(columns=[col], inplace=True)
-    logger.info(f"Converted to dataframe with {df.shape[0]} rows and {df.shape[1]} columns")
-    # Now we have the dataframe, we can write it to the output file
+    logger.info(f"Read {nrecords} records from {config['input']}")
+    colidxs = list(range(len(header))) if nrecords else []
+    if not nrecords:
+        sameidxs = []
+    for idx in sameidxs:
+        logger.info(f"Field {header[idx]} has the same value in all records: >>{firstrow[idx]}<<")
+    if not config["all"]:
+        sameidxs = set(sameidxs)
+        colidxs = [idx for idx in colidxs if idx not in sameidxs]
+    columns = [header[idx] for idx in colidxs]
+    logger.info(f"Converted to {nrecords} rows with {len(columns)} columns")
+    # Now we can convert the rows again and write them one batch at a time. The csv writer writes the file in the
+    # same format as the pandas to_csv method did before: None as an empty string and only values which contain
+    # a tab, a newline or a double quote are quoted
     outputfile = config["output"]
     if not outputfile:
         outputfile = os.path.splitext(config["input"])[0] + ".tsv"
-    df.to_csv(outputfile, sep="\t", index=False)
+    with open(outputfile, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, delimiter="\t", quoting=csv.QUOTE_MINIMAL, lineterminator=os.linesep)
+        writer.writerow(columns)
+        rows = []
+        for record in records():
+            row = flatten_record(record, template, checkidxs)
+            rows.append([row[idx] for idx in colidxs])
+            if len(rows) == TSV_BATCHSIZE:
+                writer.writerows(rows)
+                rows.clear()
+        if rows:
+            writer.writerows(rows)
     logger.info(f"Output written to {outputfile}")
     # print out the unknown fields, if there are any
     if unknownfields:
@@ -4,408 +4,193 @@
 Module for the CLI to convert the wiki-contradiction corpus to ragability input format
 """
 
-import json
+import os
 import argparse
-import pandas as pd
-import hjson
+import itertools
+import collections
+import contextlib
+from typing import List, Optional, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from logging import DEBUG
 from ragability.logging import logger, set_logging_level
 from ragability.utils import pp_config
 
 VAR = "-var01"
-
-
-def row2raga_nc(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "nc" + VAR,
-        tags="kind_no_context, kind_no_context_q, not_answerable",
-        query=row["query_text"],
-        pids=["q_no_context"],
-        checks=[
-            dict(
-                cid="no_ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-
-
-def row2raga_ctx1(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx1" + VAR,
-        tags="kind_1context, kind_1context_q, kind_context1, kind_context1_q, answerable",
-        facts=row["context_1"],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context1"]+"\nlong answer: "+row["answer_context1_long"]
-            ),
-        ],
-    )
-    return out
-
-
-def row2raga_ctx2(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx2" + VAR,
-        tags="kind_1context, kind_1context_q, kind_context2, kind_context2_q, answerable",
-        facts=row["context_2"],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context2"]+"\nlong answer: "+row["answer_context2_long"]
-            ),
-        ],
-    )
-    return out
-
-
-def row2raga_ctx12q(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx12q" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context1+2, kind_context1+2_q, kind_2contexts_q-h, not_answerable",
-        facts=[row["context_1"], row["context_2"]],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx21q(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx21q" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context2+1, kind_context2+1_q, kind_2contexts_q-h, not_answerable",
-        facts=[row["context_2"], row["context_1"]],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-    
-def row2raga_ctx13q(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx13q" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context1+3, kind_context1+3_q, kind_2contexts_q-h, answerable",
-        facts=[row["context_1"], row["context_3_nc1_c2"]],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context1"]+"\nlong answer: "+row["answer_context1_long"]
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx31q(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx31q" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context3+1, kind_context3+1_q, kind_2contexts_q-h, answerable",
-        facts=[row["context_3_nc1_c2"], row["context_1"]],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context1"]+"\nlong answer: "+row["answer_context1_long"]
-            ),
-        ],
-    )
-    return out
-
-    
-def row2raga_ctx1234q(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx1234q" + VAR,
-        tags="kind_4contexts, kind_4contexts_q, kind_context1+2+3+4, kind_context1+2+3+4_q, kind_4contexts_q-h, not_answerable",
-        facts=[row["context_1"], row["context_2"], row["context_3_nc1_c2"], row["context_4_nc1_nc2_nc3"]],
-        query=row["query_text"],
-        pids=["q_n_contexts"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx12qh(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx12qh" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context1+2, kind_context1+2_q, kind_2contexts_q+h, not_answerable",
-        facts=[row["context_1"], row["context_2"]],
-        query=row["query_text"],
-        pids=["q_n_contexts_hints"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx21qh(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx21qh" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context2+1, kind_context2+1_q, kind_2contexts_q+h, not_answerable",
-        facts=[row["context_2"], row["context_1"]],
-        query=row["query_text"],
-        pids=["q_n_contexts_hints"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-    
-def row2raga_ctx13qh(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx13qh" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context1+3, kind_context1+3_q, kind_2contexts_q+h, answerable",
-        facts=[row["context_1"], row["context_3_nc1_c2"]],
-        query=row["query_text"],
-        pids=["q_n_contexts_hints"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context1"]+"\nlong answer: "+row["answer_context1_long"]
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx31qh(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx31qh" + VAR,
-        tags="kind_2contexts, kind_2contexts_q, kind_context3+1, kind_context3+1_q, kind_2contexts_q+h, answerable",
-        facts=[row["context_3_nc1_c2"], row["context_1"]],
-        query=row["query_text"],
-        pids=["q_n_contexts_hints"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "correct_answer_answerable"],
-                pid="check_correct_answer",
-                check_for="short answer: "+row["answer_context1"]+"\nlong answer: "+row["answer_context1_long"]
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx1234qh(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx1234qh" + VAR,
-        tags="kind_4contexts, kind_4contexts_q, kind_context1+2+3+4, kind_context1+2+3+4_q, kind_4contexts_q+h, not_answerable",
-        facts=[row["context_1"], row["context_2"], row["context_3_nc1_c2"], row["context_4_nc1_nc2_nc3"]],
-        query=row["query_text"],
-        pids=["q_n_contexts_hints"],
-        checks=[
-            dict(
-                cid="2ctx_not_answerable",
-                query="",
-                func="affirmative",
-                metrics=["correct_answer_all", "refusal_not_answerable"],
-                pid="check_response_not_answerable",
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx1ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx1ic" + VAR,
-        tags="kind_1context, kind_1context_ic, kind_context1, kind_context1_ic, answerable",
-        facts=row["context_1"],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="negative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-
-
-def row2raga_ctx2ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx2ic" + VAR,
-        tags="kind_1context, kind_1context_ic, kind_context2, kind_context2_ic, answerable",
-        facts=row["context_2"],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="negative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx12ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx12ic" + VAR,
-        tags="kind_2contexts, kind_2contexts_ic, kind_context1+2, kind_context1+2_ic, answerable",
-        facts=[row["context_1"],row["context_2"]],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="affirmative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-
-
-def row2raga_ctx21ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx21ic" + VAR,
-        tags="kind_2contexts, kind_2contexts_ic, kind_context2+1, kind_context2+1_ic, answerable",
-        facts=[row["context_2"],row["context_1"]],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="affirmative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-    
-def row2raga_ctx13ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx13ic" + VAR,
-        tags="kind_2contexts, kind_2contexts_ic, kind_context1+3, kind_context1+3_ic, answerable",
-        facts=[row["context_1"],row["context_3_nc1_c2"]],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="negative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-    
-def row2raga_ctx31ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx31ic" + VAR,
-        tags="kind_2contexts, kind_2contexts_ic, kind_context3+1, kind_context3+1_ic, answerable",
-        facts=[row["context_3_nc1_c2"],row["context_1"]],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="negative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-
-def row2raga_ctx1234ic(row):
-    out = dict(
-        qid=row["contradiction_ID"] + "-" + "ctx1234ic" + VAR,
-        tags="kind_4contexts, kind_4contexts_ic, kind_context1+2+3+4, kind_context1+2+3+4_ic, not_answerable",
-        facts=[row["context_1"], row["context_2"], row["context_3_nc1_c2"], row["context_4_nc1_nc2_nc3"]],
-        query="",
-        pids=["ci_n_contexts"],
-        checks=[
-            dict(
-                cid="answer_correct",
-                func="affirmative",
-                metrics=["correct_answer_all", "contradiction_identification"],
-            ),
-        ],
-    )
-    return out
-
-
-CONVS = [
-    row2raga_nc,
-    row2raga_ctx1, row2raga_ctx2,
-    row2raga_ctx12q, row2raga_ctx21q,
-    row2raga_ctx13q, row2raga_ctx31q,
-    row2raga_ctx1234q,
-    row2raga_ctx12qh, row2raga_ctx21qh,
-    row2raga_ctx13qh, row2raga_ctx31qh,
-    row2raga_ctx1234qh,
-    row2raga_ctx1ic, row2raga_ctx2ic,
-    row2raga_ctx12ic, row2raga_ctx21ic,
-    row2raga_ctx13ic, row2raga_ctx31ic,
-    row2raga_ctx1234ic]
+# The pids and checks which are the same for all converted entries of a kind. These are shared between all
+# the converted entries, which is fine since the entries are only serialized and never modified.
+PIDS_Q_NO_CONTEXT = ("q_no_context",)
+PIDS_Q_N_CONTEXTS = ("q_n_contexts",)
+PIDS_Q_N_CONTEXTS_HINTS = ("q_n_contexts_hints",)
+PIDS_CI_N_CONTEXTS = ("ci_n_contexts",)
+
+CHECKS_NC_NOT_ANSWERABLE = (
+    {
+        "cid": "no_ctx_not_answerable",
+        "query": "",
+        "func": "affirmative",
+        "metrics": ("correct_answer_all", "refusal_not_answerable"),
+        "pid": "check_response_not_answerable",
+    },
+)
+CHECKS_CTX_NOT_ANSWERABLE = (
+    {
+        "cid": "2ctx_not_answerable",
+        "query": "",
+        "func": "affirmative",
+        "metrics": ("correct_answer_all", "refusal_not_answerable"),
+        "pid": "check_response_not_answerable",
+    },
+)
+CHECKS_IC_NEGATIVE = (
+    {
+        "cid": "answer_correct",
+        "func": "negative",
+        "metrics": ("correct_answer_all", "contradiction_identification"),
+    },
+)
+CHECKS_IC_AFFIRMATIVE = (
+    {
+        "cid": "answer_correct",
+        "func": "affirmative",
+        "metrics": ("correct_answer_all", "contradiction_identification"),
+    },
+)
+# the check for a correct answer also needs the answer to check for, which is added for each entry
+CHECK_ANSWER_CORRECT = {
+    "cid": "answer_correct",
+    "query": "",
+    "func": "affirmative",
+    "metrics": ("correct_answer_all", "correct_answer_answerable"),
+    "pid": "check_correct_answer",
+}
+
+# the input columns used by the conversions
+INPUT_COLUMNS = (
+    "contradiction_ID", "query_text",
+    "context_1", "context_2", "context_3_nc1_c2", "context_4_nc1_nc2_nc3",
+    "answer_context1", "answer_context1_long", "answer_context2", "answer_context2_long")
+
+# the meta data fields which are copied over from the input row to each converted entry, if present
+META_FIELDS = ("WikiContradict_ID", "reasoning_required_c1c2", "c1xq", "c2xq")
+
+# size of the buffer for writing the output file, the output is written in large chunks anyway, so this avoids
+# splitting the chunks into many small writes
+OUTPUT_BUFSIZE = 1 << 22
+
+# size in bytes of the blocks of the input file which are read and converted together, this is also the unit of
+# work for each worker process
+CONV_BLOCKSIZE = 1 << 20
+
+
+# The table of conversions: for each input row, one entry is created for each of the conversions. Each conversion
+# is a tuple with the following elements:
+# - the kind of conversion, which is used in the qid of the entry
+# - the tags of the entry
+# - None if the entry has no facts, the input column with the single fact or a tuple of the input columns with the
+#   facts, in order
+# - the input column with the query or None for an empty query
+# - the pids of the entry
+# - the checks of the entry or, if the entry needs a check with the text to check for, the template for that check
+# - None or the column with the text to check for
+CONV_TABLE = [
+    ("nc",
+     "kind_no_context, kind_no_context_q, not_answerable",
+     None, "query_text", PIDS_Q_NO_CONTEXT, CHECKS_NC_NOT_ANSWERABLE, None),
+    ("ctx1",
+     "kind_1context, kind_1context_q, kind_context1, kind_context1_q, answerable",
+     "context_1", "query_text", PIDS_Q_N_CONTEXTS, CHECK_ANSWER_CORRECT, "check_for_context1"),
+    ("ctx2",
+     "kind_1context, kind_1context_q, kind_context2, kind_context2_q, answerable",
+     "context_2", "query_text", PIDS_Q_N_CONTEXTS, CHECK_ANSWER_CORRECT, "check_for_context2"),
+    ("ctx12q",
+     "kind_2contexts, kind_2contexts_q, kind_context1+2, kind_context1+2_q, kind_2contexts_q-h, not_answerable",
+     ("context_1", "context_2"), "query_text", PIDS_Q_N_CONTEXTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx21q",
+     "kind_2contexts, kind_2contexts_q, kind_context2+1, kind_context2+1_q, kind_2contexts_q-h, not_answerable",
+     ("context_2", "context_1"), "query_text", PIDS_Q_N_CONTEXTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx13q",
+     "kind_2contexts, kind_2contexts_q, kind_context1+3, kind_context1+3_q, kind_2contexts_q-h, answerable",
+     ("context_1", "context_3_nc1_c2"), "query_text", PIDS_Q_N_CONTEXTS, CHECK_ANSWER_CORRECT, "check_for_context1"),
+    ("ctx31q",
+     "kind_2contexts, kind_2contexts_q, kind_context3+1, kind_context3+1_q, kind_2contexts_q-h, answerable",
+     ("context_3_nc1_c2", "context_1"), "query_text", PIDS_Q_N_CONTEXTS, CHECK_ANSWER_CORRECT, "check_for_context1"),
+    ("ctx1234q",
+     "kind_4contexts, kind_4contexts_q, kind_context1+2+3+4, kind_context1+2+3+4_q, kind_4contexts_q-h, not_answerable",
+     ("context_1", "context_2", "context_3_nc1_c2", "context_4_nc1_nc2_nc3"), "query_text", PIDS_Q_N_CONTEXTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx12qh",
+     "kind_2contexts, kind_2contexts_q, kind_context1+2, kind_context1+2_q, kind_2contexts_q+h, not_answerable",
+     ("context_1", "context_2"), "query_text", PIDS_Q_N_CONTEXTS_HINTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx21qh",
+     "kind_2contexts, kind_2contexts_q, kind_context2+1, kind_context2+1_q, kind_2contexts_q+h, not_answerable",
+     ("context_2", "context_1"), "query_text", PIDS_Q_N_CONTEXTS_HINTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx13qh",
+     "kind_2contexts, kind_2contexts_q, kind_context1+3, kind_context1+3_q, kind_2contexts_q+h, answerable",
+     ("context_1", "context_3_nc1_c2"), "query_text", PIDS_Q_N_CONTEXTS_HINTS, CHECK_ANSWER_CORRECT, "check_for_context1"),
+    ("ctx31qh",
+     "kind_2contexts, kind_2contexts_q, kind_context3+1, kind_context3+1_q, kind_2contexts_q+h, answerable",
+     ("context_3_nc1_c2", "context_1"), "query_text", PIDS_Q_N_CONTEXTS_HINTS, CHECK_ANSWER_CORRECT, "check_for_context1"),
+    ("ctx1234qh",
+     "kind_4contexts, kind_4contexts_q, kind_context1+2+3+4, kind_context1+2+3+4_q, kind_4contexts_q+h, not_answerable",
+     ("context_1", "context_2", "context_3_nc1_c2", "context_4_nc1_nc2_nc3"), "query_text", PIDS_Q_N_CONTEXTS_HINTS, CHECKS_CTX_NOT_ANSWERABLE, None),
+    ("ctx1ic",
+     "kind_1context, kind_1context_ic, kind_context1, kind_context1_ic, answerable",
+     "context_1", None, PIDS_CI_N_CONTEXTS, CHECKS_IC_NEGATIVE, None),
+    ("ctx2ic",
+     "kind_1context, kind_1context_ic, kind_context2, kind_context2_ic, answerable",
+     "context_2", None, PIDS_CI_N_CONTEXTS, CHECKS_IC_NEGATIVE, None),
+    ("ctx12ic",
+     "kind_2contexts, kind_2contexts_ic, kind_context1+2, kind_context1+2_ic, answerable",
+     ("context_1", "context_2"), None, PIDS_CI_N_CONTEXTS, CHECKS_IC_AFFIRMATIVE, None),
+    ("ctx21ic",
+     "kind_2contexts, kind_2contexts_ic, kind_context2+1, kind_context2+1_ic, answerable",
+     ("context_2", "context_1"), None, PIDS_CI_N_CONTEXTS, CHECKS_IC_AFFIRMATIVE, None),
+    ("ctx13ic",
+     "kind_2contexts, kind_2contexts_ic, kind_context1+3, kind_context1+3_ic, answerable",
+     ("context_1", "context_3_nc1_c2"), None, PIDS_CI_N_CONTEXTS, CHECKS_IC_NEGATIVE, None),
+    ("ctx31ic",
+     "kind_2contexts, kind_2contexts_ic, kind_context3+1, kind_context3+1_ic, answerable",
+     ("context_3_nc1_c2", "context_1"), None, PIDS_CI_N_CONTEXTS, CHECKS_IC_NEGATIVE, None),
+    ("ctx1234ic",
+     "kind_4contexts, kind_4contexts_ic, kind_context1+2+3+4, kind_context1+2+3+4_ic, not_answerable",
+     ("context_1", "context_2", "context_3_nc1_c2", "context_4_nc1_nc2_nc3"), None, PIDS_CI_N_CONTEXTS, CHECKS_IC_AFFIRMATIVE, None),
+]
+
+
+def convert_rows(conversion: tuple, cols: dict, qids: list, factcache: dict) -> list:
+    """
+    Create the entries for one of the conversions in CONV_TABLE for all the input rows.
+    :param conversion: the tuple describing the conversion
+    :param cols: a dict with the list of values of each input column
+    :param qids: the list of qids for the entries
+    :param factcache: a dict mapping each tuple of fact columns to the lists of facts already created for it, so
+        that conversions with the same facts share the lists. The entries are only serialized, so this is safe.
+    :return: the list of entries, one for each input row
+    """
+    _, tags, facts, query, pids, checks, check_for = conversion
+    queries = cols[query] if query else itertools.repeat("")
+    if check_for:
+        checkvals = [[{**checks, "check_for": text}] for text in cols[check_for]]
+    else:
+        checkvals = itertools.repeat(checks)
+    if facts is None:
+        return [
+            {"qid": qid, "tags": tags, "query": q, "pids": pids, "checks": c}
+            for qid, q, c in zip(qids, queries, checkvals)
+        ]
+    if isinstance(facts, str):
+        factvals = cols[facts]
+    else:
+        factvals = factcache.get(facts)
+        if factvals is None:
+            factvals = factcache[facts] = [list(f) for f in zip(*[cols[col] for col in facts])]
+    return [
+        {"qid": qid, "tags": tags, "facts": f, "query": q, "pids": pids, "checks": c}
+        for qid, f, q, c in zip(qids, factvals, queries, checkvals)
+    ]
 
 
 def get_args():
@@ -414,9 +199,15 @@ def get_args():
     """
     parser = argparse.ArgumentParser(description='Convert the WikiContradict-based datast to ragability input format')
     parser.add_argument('--input', '-i', type=str, help='Input TSV file', required=False)
-    parser.add_argument('--output', '-o', type=str, help='Output hjson,json file', required=False)
+    parser.add_argument('--output', '-o', type=str,
+                        help='Output jsonl, json or hjson file (same as input but with jsonl extension)', required=False)
     parser.add_argument('--maxn', '-n', type=int, help='Maximum number of input rows to process', required=False)
     parser.add_argument('--promptfile', '-p', type=str, help='Promptfile to write with the default prompts (do not write)', required=False)
+    parser.add_argument('--nworkers', type=int, default=1,
+                        help='Number of worker processes to use for the conversion, 0 for one per CPU (1)', required=False)
+    parser.add_argument('--shard-per-variant', action="store_true",
+                        help='Write the entries of each conversion to a separate jsonl file OUTPUTBASE.KIND.jsonl',
+                        required=False)
     parser.add_argument("--debug", "-d", action="store_true", help="Debug mode", required=False)
     args_tmp = parser.parse_args()
     args = {}
@@ -424,9 +215,108 @@ def get_args():
     return args
 
 
+def read_tsv_header(input_file: str) -> List[str]:
+    """
+    Read the column names from the first line of the TSV file.
+    :param input_file: the TSV file
+    :return: the list of column names
+    """
+    with open(input_file, "rt") as infp:
+        return infp.readline().rstrip("\r\n").split("\t")
+
+
+def iter_tsv_batches(input_file: str, columns: List[str], maxn: Optional[int] = None) -> Iterator[pa.RecordBatch]:
+    """
+    Read the TSV file with the streaming pyarrow reader and yield one record batch for each block of the file, so
+    that only the batches currently being converted are kept in memory. All columns are read as strings and
+    empty values are kept as empty strings, not converted to missing values.
+    :param input_file: the TSV file to read, the first line must contain the column names
+    :param columns: the columns to read, these must be present in the file, all other columns are skipped by the parser
+    :param maxn: if not None, stop after that many rows
+    :return: iterator over the record batches
+    """
+    # the blocks are parsed with multiple threads, quoted values may contain newlines in this corpus, so that option
+    # has to be enabled even though it makes splitting the file into blocks for the threads more expensive
+    reader = pacsv.open_csv(
+        input_file,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=CONV_BLOCKSIZE),
+        parse_options=pacsv.ParseOptions(delimiter="\t", newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in columns},
+                                             include_columns=columns,
+                                             strings_can_be_null=False))
+    nrows = 0
+    for batch in reader:
+        if maxn is not None and nrows + batch.num_rows >= maxn:
+            yield batch.slice(0, maxn - nrows)
+            return
+        nrows += batch.num_rows
+        yield batch
+
+
+def map_ordered(executor: ProcessPoolExecutor, func, items: Iterable, *args, maxpending: int = 1) -> Iterator:
+    """
+    Like executor.map(func, items, ...) but only submit the next item when fewer than maxpending items are
+    being processed, so items are not all read into memory at once. The results are returned in the order of the items.
+    :param executor: the executor to use
+    :param func: the function to call for each item, with the item as the first argument, followed by args
+    :param items: the items to process
+    :param args: additional arguments to pass to the function
+    :param maxpending: the maximum number of items submitted but not yet returned
+    :return: iterator over the results
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item, *args))
+        if len(pending) >= maxpending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def convert_chunk(table: pa.RecordBatch, outfmt: str, shard: bool = False):
+    """
+    Convert all the rows in the record batch with all conversions in CONV_TABLE. This is run in a worker process if
+    the conversion is done in parallel.
+    :param table: the record batch with the rows to convert
+    :param outfmt: the output file extension: for ".jsonl" return the converted entries serialized as jsonl, for
+        ".json" and ".hjson" return them serialized as json array elements separated by commas
+    :param shard: if True, return a list with the entries of each conversion serialized separately as jsonl
+    :return: a tuple with the number of converted entries and the serialized bytes or list of serialized bytes
+    """
+    # build the qids for all rows and conversions with vectorized string operations
+    qidcols = [pc.binary_join_element_wise(table["contradiction_ID"], f"-{kind}{VAR}", "").to_pylist()
+               for kind, *_ in CONV_TABLE]
+    # the meta data fields to copy over, all rows have the same columns
+    metafields = [field for field in META_FIELDS if field in table.column_names]
+    cols = {name: table[name].to_pylist() for name in INPUT_COLUMNS + tuple(metafields)}
+    # the texts to check for in the answer correct checks are also built with vectorized string operations
+    for n in (1, 2):
+        cols[f"check_for_context{n}"] = pc.binary_join_element_wise(
+            "short answer: ", table[f"answer_context{n}"], "\nlong answer: ", table[f"answer_context{n}_long"],
+            "").to_pylist()
+    # convert all the rows with each of the conversions, then output the entries for each row in turn
+    factcache = {}
+    convcols = [convert_rows(conversion, cols, qids, factcache) for conversion, qids in zip(CONV_TABLE, qidcols)]
+    metacols = [(field, cols[field]) for field in metafields]
+    if metacols:
+        for crows in convcols:
+            for idx, crow in enumerate(crows):
+                for field, vals in metacols:
+                    crow[field] = vals[idx]
+    nentries = len(convcols) * table.num_rows
+    if shard:
+        return nentries, [b"".join(orjson.dumps(crow) + b"\n" for crow in crows) for crows in convcols]
+    entries = (crow for crows in zip(*convcols) for crow in crows)
+    if outfmt == ".jsonl":
+        return nentries, b"".join(orjson.dumps(crow) + b"\n" for crow in entries)
+    return nentries, b",\n".join(orjson.dumps(crow, option=orjson.OPT_INDENT_2) for crow in entries)
+
+
 def run(config: dict):
     pfile = config.get("promptfile")
     if pfile:
+        # hjson is only needed for the prompt file, so it is only imported when used
+        import hjson
         with open(pfile, "wt") as outfp:
             hjson.dump(PROMPTS, outfp)
         logger.info(f"Prompts written to {pfile}")
@@ -434,43 +324,74 @@ def run(config: dict):
         logger.info("No input file given, exiting")
         return
     if not config.get("output"):
-        logger.error("Output file must be given if input file is specified")
-        return
-    df = pd.read_csv(config["input"], sep="\t", dtype="string", na_filter=False)
-    logger.info(f"Read {len(df)} rows with {df.shape[1]} columns from {config['input']}")
-
-    # write either a jsonl or json file, depending on the file extension
-    if not config['output'].endswith(".json") and not config['output'].endswith(".jsonl") and not config['output'].endswith(".hjson"):
+        config["output"] = os.path.splitext(config["input"])[0] + ".jsonl"
+        logger.info(f"No output file given, writing to {config['output']}")
+    colnames = read_tsv_header(config["input"])
+    missing = [name for name in INPUT_COLUMNS if name not in colnames]
+    if missing:
+        raise Exception(f"Error: Input file {config['input']} is missing the columns {', '.join(missing)}")
+    if config.get("maxn"):
+        logger.info(f"Processing only the first {config['maxn']} rows")
+
+    # write either a jsonl, json or hjson file, depending on the file extension which is checked only once
+    outfmt = os.path.splitext(config['output'])[1]
+    if outfmt not in (".json", ".jsonl", ".hjson"):
         raise Exception(f"Error: Output file must end in .json, .jsonl or .hjson, not {config['output']}")
-    with open(config['output'], 'wt') as f:
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("[\n")
-
-        colnames = ["index"] + list(df.columns)
-        n_rows = 0
-        n_inputs = 0
-        for row in df.itertuples(name=None):
-            n_inputs += 1
-            rowdict = {cn: cv for cn, cv in zip(colnames, row)}
-            for conv in CONVS:
-                crow = conv(rowdict)
-                # copy over the meta data fields
-                for field in ["WikiContradict_ID", "reasoning_required_c1c2", "c1xq", "c2xq"]:
-                    if field in rowdict:
-                        crow[field] = rowdict[field]
-                n_rows += 1
-                if config['output'].endswith(".json"):
-                    f.write(json.dumps(crow, indent=2) + "\n")
-                elif config['output'].endswith(".hjson"):
-                    f.write(hjson.dumps(crow, indent=2) + "\n")
-                else:
-                    f.write(json.dumps(crow) + "\n")
-            if config.get("maxn") and n_inputs >= config["maxn"]:
-                logger.info(f"Processed {n_inputs} rows, stopping")
-                break
-
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("]\n")
+    if outfmt != ".jsonl":
+        if config.get("shard_per_variant"):
+            raise Exception(f"Error: Option --shard-per-variant needs a .jsonl output file, not {config['output']}")
+        logger.warning(f"Writing a {outfmt} file is slower, consider using .jsonl")
+    # The input file is read one block at a time and the rows of each block are converted together, either in this
+    # process or in parallel in worker processes, the results are processed in the order of the blocks so the output
+    # is the same in both cases. Only the columns we need are read, so that parsing is faster and less data has to
+    # be sent to the worker processes.
+    # Each chunk is serialized in the worker and written as soon as it is available, for json and hjson output the
+    # array brackets and the commas between the chunks are written here. The hjson file is written as plain json
+    # which is also valid hjson, since the entries do not need any of the hjson features.
+    columns = list(INPUT_COLUMNS) + [name for name in META_FIELDS if name in colnames]
+    chunks = iter_tsv_batches(config["input"], columns, config.get("maxn") or None)
+    nworkers = config.get("nworkers")
+    if nworkers is None:
+        nworkers = 1
+    elif nworkers == 0:
+        nworkers = os.cpu_count() or 1
+    # With --shard-per-variant, the entries of each conversion are written to their own jsonl file named after the
+    # kind of conversion instead, so that they can be processed separately
+    shard = bool(config.get("shard_per_variant"))
+    if shard:
+        outfiles = [f"{os.path.splitext(config['output'])[0]}.{kind}.jsonl" for kind, *_ in CONV_TABLE]
+    else:
+        outfiles = [config['output']]
+    n_rows = 0
+    with contextlib.ExitStack() as stack:
+        fps = [stack.enter_context(open(outfile, 'wb', buffering=OUTPUT_BUFSIZE)) for outfile in outfiles]
+        f = fps[0]
+        if nworkers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=nworkers))
+            # keep enough blocks submitted so that all workers stay busy while the results are written
+            results = map_ordered(executor, convert_chunk, chunks, outfmt, shard, maxpending=2 * nworkers)
+        else:
+            results = (convert_chunk(chunk, outfmt, shard) for chunk in chunks)
+        # the function to process the result for one chunk is chosen once, it gets the number of entries
+        # processed before the chunk, so that the json array elements can be separated by commas
+        if shard:
+            def write_chunk(n_before, result):
+                for fp, data in zip(fps, result):
+                    fp.write(data)
+        elif outfmt == ".jsonl":
+            write_chunk = lambda n_before, result: f.write(result)
+        else:
+            f.write(b"[\n")
+            write_chunk = lambda n_before, result: f.write(b",\n" + result if n_before and result else result)
+        for n, result in results:
+            write_chunk(n_rows, result)
+            n_rows += n
+        if outfmt != ".jsonl":
+            f.write(b"\n]\n")
+    logger.info(f"Read and converted {n_rows // len(CONV_TABLE)} rows from {config['input']}")
+    if shard:
+        logger.info(f"Written {n_rows} entries to {len(outfiles)} files {outfiles[0]} ... {outfiles[-1]}")
+    else:
         logger.info(f"Written {n_rows} entries to {config['output']}")
 
 
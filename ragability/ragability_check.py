@@ -5,24 +5,38 @@ Module to check responses against target facts and assign scores. This creates a
 can then be used to calculate summary statistics in various ways.
 """
 
+import os
 import sys
-import json
 import argparse
 import datetime
+import contextlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import hjson
+import orjson
+import pandas as pd
 from logging import DEBUG
-from ragability.data import read_input_file, read_prompt_file
+from ragability.data import iter_input_file, read_prompt_file
 from llms_wrapper.config import read_config_file, update_llm_config
 from ragability.logging import logger, set_logging_level, add_logging_file
 from llms_wrapper.llms import LLMS, LLM
 from ragability.utils import pp_config
-from ragability.checks import CHECKS
+from ragability.checks import CHECKS, BATCH_CHECKS
+from ragability.cache import ResponseCache
 
 DEFAULT_PROMPT = {
     "system": "You are an expert analyzing responses and how they related to desired facts or properties of the responses. You will be given the response following RESPONSE: and before QUERY:, and a query telling you what to analyze after QUERY:",
     "user": "RESPONSE: ${response} QUERY: ${query}",
 }
 
+# the number of examples which are checked and written to the output file together
+CHECK_BATCHSIZE = 1000
+# the size of the write buffer of the output file
+OUTPUT_BUFSIZE = 1 << 20
+# the minimum number of checks with the same function and arguments for which the batched variant of the check
+# function is used, for fewer checks the scalar function is faster
+BATCH_CHECK_MINSIZE = 32
+
 # TODO: allow ${fact0} to ${fact9} as substitution fields.
 
 
@@ -38,6 +52,16 @@ def get_args():
     parser.add_argument("--promptfile", "-pf", type=str, help="File with the prompt to use for the checking queries (or use config), jsonl, json, yaml", required=False)
     parser.add_argument("--all", "-a", action="store_true", help="Run all queries, even if they have a response", required=False)
     parser.add_argument("--logfile", "-f", type=str, help="Log file", required=False)
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse the checker-LLM response for identical queries", required=False)
+    parser.add_argument("--cachefile", type=str,
+                        help="Sqlite file to keep the checker-LLM response cache in between runs (implies --cache)",
+                        required=False)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of checker-LLM queries to run at the same time (1)", required=False)
+    parser.add_argument("--nworkers", type=int, default=1,
+                        help="Number of worker processes for the checks which do not need the checker-LLM and for checking the entries of a json, hjson or yaml input file, 0 for one per CPU (1)",
+                        required=False)
     parser.add_argument("--dry-run", "-n", action="store_true", help="Dry run, do not actually run the queries", required=False)
     parser.add_argument("--verbose", "-v", action="store_true", help="Be more verbose and inform what is happening", required=False)
     parser.add_argument("--debug", "-d", action="store_true", help="Debug mode", required=False)
@@ -85,28 +109,30 @@ def check_check(check: dict, example: dict, config: dict) -> bool:
     """
     # make sure the func field is present and that the func field is a string
     # now if the func is not LLM, we can use the function directly, otherwise we need to query the LLM
-    if "func" not in check:
-        logger.warning(f"Warning: Missing 'func' field in check in example {example['qid']}")
-        return False
-    if "metrics" not in check:
-        logger.warning(f"Warning: Missing 'metrics' field in check in example {example['qid']}")
-        return False
-    if not isinstance(check["func"], str):
-        logger.warning(f"Warning: 'func' field in check must be a string in example {example['qid']}")
-        return False
-    # make sure the function is in the CHECKS dictionary
-    if check["func"] not in CHECKS:
-        logger.warning(f"Warning: Check function {check['func']} not in CHECKS in example {example['qid']}")
-        return False
-    func = CHECKS[check["func"]]
-    # check if the number of parameters defined with "parms" matches the number of parameters required by the function
-    nargs = func["nargs"]
-    args = check.get("args", [])
-    if nargs != len(args):
-        logger.warning(f"Warning: Wrong number of positional arguments in check for function {func['func']} in example {example['qid']}: {len(args)} instead of {nargs}")
+    # the common case of a valid check is decided with a single lookup of each field and of the check function,
+    # the reason for an invalid check is only figured out if the check is not valid
+    funcname = check.get("func")
+    func = CHECKS.get(funcname) if isinstance(funcname, str) else None
+    if func is None or "metrics" not in check or func["nargs"] != len(check.get("args", ())):
+        if "func" not in check:
+            logger.warning(f"Warning: Missing 'func' field in check in example {example['qid']}")
+        elif "metrics" not in check:
+            logger.warning(f"Warning: Missing 'metrics' field in check in example {example['qid']}")
+        elif not isinstance(funcname, str):
+            logger.warning(f"Warning: 'func' field in check must be a string in example {example['qid']}")
+        elif func is None:
+            # make sure the function is in the CHECKS dictionary
+            logger.warning(f"Warning: Check function {funcname} not in CHECKS in example {example['qid']}")
+        else:
+            # check if the number of parameters defined with "parms" matches the number of parameters required by
+            # the function
+            nargs = func["nargs"]
+            args = check.get("args", [])
+            logger.warning(f"Warning: Wrong number of positional arguments in check for function {func['func']} in example {example['qid']}: {len(args)} instead of {nargs}")
         return False
     if not config['all'] and "result" in check:
-        logger.debug(f"Skipping check {check['query']} with result")
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(f"Skipping check {check.get('query')} with result")
         return False
     return True
 
@@ -151,14 +177,27 @@ def run_check(check, llm: LLM, example, config, debug=False):
             response = ""
             error = "NOT RUN: DRY-RUN"
             return
-        if config['verbose']:
-            logger.info(f"Querying checker-LLM {llmname} for example {example['qid']} and check {cid}")
-        ret = llm.query(messages=messages, return_cost=True, debug=config['debug'])
+        # if we have a cached response for the same messages, use it instead of querying the LLM again
+        cache = config.get("response_cache")
+        key = None
+        cached = None
+        if cache is not None:
+            key = cache.make_key(llmname, messages, llm["llm"])
+            cached = cache.get(key)
+        if cached is not None:
+            logger.debug(f"Using cached checker-LLM response for example {example['qid']} and check {cid}")
+            ret = {"answer": cached, "cost": 0}
+        else:
+            if config['verbose']:
+                logger.info(f"Querying checker-LLM {llmname} for example {example['qid']} and check {cid}")
+            ret = llm.query(messages=messages, return_cost=True, debug=config['debug'])
         response = ret.get("answer", "")
         check["cost"] = ret.get("cost", 0)
         check["response"] = response
         error = ret.get("error", "")
         check["llm"] = llmname
+        if cache is not None and cached is None and not error:
+            cache.put(key, response, check["cost"])
         # if we had an error with the checker LLM, log it and return, we cannot check the response
         if error:
             logger.warning(f"Error from checking LLM, cannot check: {error}")
@@ -167,23 +206,153 @@ def run_check(check, llm: LLM, example, config, debug=False):
             return
     else:
         response = example["response"]
-    func_config = CHECKS[check["func"]]
-    func = func_config["func"]
-    nargs = func_config["nargs"]
+    nargs = CHECKS[check["func"]]["nargs"]
     args = check.get("args", [])
-    assert len(args) == nargs, f"Error: Wrong number of positional arguments in check for function {func['func']}: {len(args)} instead of {nargs}"
+    assert len(args) == nargs, f"Error: Wrong number of positional arguments in check for function {check['func']}: {len(args)} instead of {nargs}"
     kwargs = check.get("kwargs", {})
-    try:
-        result = func(response, *args, **kwargs)
-        error = ""
-    except Exception as e:
-        logger.error(f"Error in check function {func}: {e}")
-        result = None
-        error = f"Error in check function {func}: {e}"
+    result, error = run_check_func(check["func"], response, args, kwargs)
+    if error:
+        logger.error(error)
     check["result"] = result
     check["error"] = error
 
 
+def run_check_func(funcname: str, response: str, args: list, kwargs: dict):
+    """
+    Run the check function with the given name on the response. This does not log anything, so that it can also
+    be run in a worker process.
+
+    :param funcname: the name of the check function in CHECKS
+    :param response: the response to check
+    :param args: the positional arguments for the check function
+    :param kwargs: the keyword arguments for the check function
+    :return: a tuple (result, error) where error is the empty string if the function succeeded
+    """
+    func = CHECKS[funcname]["func"]
+    try:
+        return func(response, *args, **kwargs), ""
+    except Exception as e:
+        return None, f"Error in check function {func}: {e}"
+
+
+def run_func_checks_parallel(todo: list, config: dict, executor: ProcessPoolExecutor):
+    """
+    Run the given checks which do not need the checker-LLM in worker processes, so that CPU heavy check
+    functions can use all cores.
+
+    :param todo: a list of (example, check) tuples
+    :param config: the configuration
+    :param executor: the process pool to run the checks in
+    """
+    checks = []
+    jobs = []
+    for example, check in todo:
+        if not check_check(check, example, config):
+            logger.debug(f"Skipping check in example {example['qid']}")
+            continue
+        checks.append(check)
+        jobs.append((check["func"], example["response"], check.get("args", []), check.get("kwargs", {})))
+    if not jobs:
+        return
+    results = executor.map(run_check_func, *zip(*jobs), chunksize=64)
+    for check, (result, error) in zip(checks, results):
+        if error:
+            logger.error(error)
+        check["result"] = result
+        check["error"] = error
+
+
+def run_batch_func_checks(todo: list, config: dict) -> list:
+    """
+    Run the given checks which do not need the checker-LLM and have a batched variant of the check function:
+    the checks are grouped by the check function and its arguments, and the batched variant is called once for each
+    group on all the responses of the group. Only checks on string responses without keyword arguments are run this
+    way, and only groups of at least BATCH_CHECK_MINSIZE checks.
+
+    :param todo: a list of (example, check) tuples
+    :param config: the configuration
+    :return: the list of (example, check) tuples which were not run and still have to be run with the scalar function
+    """
+    remaining = []
+    groups = {}
+    for example, check in todo:
+        funcname = check.get("func")
+        if (check.get("query") is not None or funcname not in BATCH_CHECKS or check.get("kwargs")
+                or not isinstance(example.get("response"), str)):
+            remaining.append((example, check))
+            continue
+        if not check_check(check, example, config):
+            logger.debug(f"Skipping check in example {example['qid']}")
+            continue
+        args = check.get("args", [])
+        groups.setdefault((funcname, orjson.dumps(args)), (args, []))[1].append((example, check))
+    for (funcname, _), (args, group) in groups.items():
+        if len(group) < BATCH_CHECK_MINSIZE:
+            remaining.extend(group)
+            continue
+        responses = pd.Series([example["response"] for example, _ in group], dtype=object)
+        try:
+            results = BATCH_CHECKS[funcname](responses, *args).tolist()
+        except Exception as e:
+            # let the scalar function find and report the error for each of the checks
+            logger.debug(f"Error in batched check function {funcname}, using the scalar function: {e}")
+            remaining.extend(group)
+            continue
+        for (_, check), result in zip(group, results):
+            check["result"] = result
+            check["error"] = ""
+    return remaining
+
+
+async def run_checks_async(todo: list, llm: LLM, config: dict):
+    """
+    Run all the given checks, at most config["concurrency"] at the same time. The LLM API is synchronous, so each
+    check is run in a thread, which is fine since the time is spent waiting for the LLM responses.
+
+    :param todo: a list of (example, check) tuples
+    :param llm: the checker LLM
+    :param config: the configuration
+    """
+    concurrency = max(1, config.get("concurrency") or 1)
+    sem = asyncio.Semaphore(concurrency)
+    # the default executor may have fewer threads than the concurrency we want
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    async def bounded(example, check):
+        async with sem:
+            await asyncio.to_thread(run_check, check, llm, example, config, debug=config["debug"])
+
+    await asyncio.gather(*[bounded(example, check) for example, check in todo])
+
+
+def run_checks_batch(examples: list, llm: LLM, config: dict, executor=None):
+    """
+    Run all the checks of the given examples and store the results in the checks.
+
+    Go through each of the checks: if we already have a check result, skip unless the --all option is given.
+    If the function is LLM, we need to run the function on the result of querying the LLM, otherwise
+    we directly run the function on the response from the query stage.
+    With a concurrency of more than 1, the checks are run concurrently, since most of the time is spent waiting for
+    the checker-LLM.
+
+    :param examples: the list of examples to check
+    :param llm: the checker LLM
+    :param config: the configuration
+    :param executor: if not None, the process pool in which the checks which do not need the checker-LLM are run
+    """
+    todo = [(example, check) for example in examples for check in example["checks"]]
+    todo = run_batch_func_checks(todo, config)
+    if executor is not None:
+        functodo = [(example, check) for example, check in todo if check.get("query") is None]
+        todo = [(example, check) for example, check in todo if check.get("query") is not None]
+        run_func_checks_parallel(functodo, config, executor)
+    if config.get("concurrency") and config["concurrency"] > 1:
+        asyncio.run(run_checks_async(todo, llm, config))
+    else:
+        for example, check in todo:
+            run_check(check, llm, example, config, debug=config["debug"])
+
+
 def run(config: dict):
     # check the configuration: for checkking, we want exactly one LLM to be configured and we want
     # to have a single prompt or no promot configured. If no prompt is configured, a default prompt will be used.
@@ -203,10 +372,8 @@ def run(config: dict):
     if len(config["prompts"]) == 0:
         theprompt = DEFAULT_PROMPT
         logger.warning(f"Warning: No prompt configured, using default prompt")
-    # read the input file into memory, we do not expect it to be too large and we want to check the format
-    # of all json lines
-    inputs = read_input_file(config["input"])
-    logger.info(f"Loaded {len(inputs)} queries from {config['input']}")
+    # the input file is read one example at a time and the examples are checked and written in batches, so that
+    # only one batch of examples has to be kept in memory
     logger.info(f"LLM to use: {llmname}")
     logger.info(f"Prompts found: {len(config['prompts_dict'])}")
 
@@ -215,18 +382,61 @@ def run(config: dict):
     llm: LLM = llms[llmname]
 
     if not config['output']:
-        config['output'] = f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.checked.hsjon"
-    # write either a jsonl or json file, depending on the file extension
-    if not config['output'].endswith(".json") and not config['output'].endswith(".jsonl") and not config[
-        'output'].endswith(".hjson"):
-        print(f"Error: Output file must end in .json, .jsonl or .hjson, not {config['output']}")
+        config['output'] = f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.checked.hjson"
+    # write either a jsonl, json or hjson file, depending on the file extension, the function to serialize each
+    # example is chosen only once. For json and hjson, the examples are the elements of an array.
+    outfmt = os.path.splitext(config['output'])[1]
+    if outfmt == ".json":
+        serialize = lambda example: orjson.dumps(example, option=orjson.OPT_INDENT_2)
+    elif outfmt == ".hjson":
+        serialize = lambda example: hjson.dumps(example, indent=2).encode("utf-8")
+    else:
+        if outfmt != ".jsonl":
+            print(f"Error: Output file must end in .json, .jsonl or .hjson, not {config['output']}")
+        serialize = lambda example: orjson.dumps(example) + b"\n"
+    is_array = outfmt in (".json", ".hjson")
+    n_inputs = 0
     n_errors = 0
     n_outputs = 0
     total_cost = 0
-    with open(config['output'], 'w') as f:
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("[\n")
-        for example in inputs:
+    if config.get("cache") or config.get("cachefile"):
+        config["response_cache"] = ResponseCache(config.get("cachefile"))
+    # With more than one worker process, the checks which do not need the checker-LLM are run in the worker
+    # processes, the same worker processes are used for all batches
+    nworkers = config.get("nworkers")
+    if nworkers is None:
+        nworkers = 1
+    elif nworkers == 0:
+        nworkers = os.cpu_count() or 1
+    if nworkers > 1:
+        logger.info(f"Running checks without checker-LLM in {nworkers} worker processes")
+    executor_ctx = ProcessPoolExecutor(max_workers=nworkers) if nworkers > 1 else contextlib.nullcontext()
+    with open(config['output'], 'wb', buffering=OUTPUT_BUFSIZE) as f, executor_ctx as executor:
+        if is_array:
+            f.write(b"[\n")
+
+        def write_examples(examples):
+            # the serialized examples of the batch are written with a single writelines call
+            nonlocal n_errors, n_outputs, total_cost
+            parts = []
+            for example in examples:
+                for check in example["checks"]:
+                    cost = check.get("cost", 0)
+                    total_cost += cost
+                    if check.get("error"):
+                        logger.warning(f"Error in check {check.get('query')}: {check['error']}")
+                        n_errors += 1
+                # write the example to the output file, the elements of a json or hjson array are separated by commas
+                if is_array and n_outputs:
+                    parts.append(b",\n")
+                parts.append(serialize(example))
+                n_outputs += 1
+            f.writelines(parts)
+
+        # collect the examples which can be checked into batches
+        batch = []
+        for example in iter_input_file(config["input"], nworkers=nworkers):
+            n_inputs += 1
             # check if the example has checks at all, give a warning if not
             if not "checks" in example or len(example["checks"]) == 0:
                 logger.warning(f"Warning: No checks in example {example['qid']}")
@@ -235,29 +445,23 @@ def run(config: dict):
             if example.get("error"):
                 logger.warning(f"Skipping example {example['qid']} with error: {example['error']}")
                 continue
-            # now go through each of the checks: if we already have a check result, skip unless the --all option is given
-            # if the function is LLM, we need to run the function on the result of querying the LLM, otherwise
-            # we directly run the function on the response from the query stage
-            for check in example["checks"]:
-                run_check(check, llm, example, config, debug=config["debug"])
-                cost = check.get("cost", 0)
-                total_cost += cost
-                if check.get("error"):
-                    logger.warning(f"Error in check {check['query']}: {check['error']}")
-                    n_errors += 1
-            # write the example to the output file
-            towrite = example
-            n_outputs += 1
-            if config['output'].endswith(".json"):
-                f.write(json.dumps(towrite, indent=2) + "\n")
-            elif config['output'].endswith(".hjson"):
-                f.write(hjson.dumps(towrite, indent=2) + "\n")
-            else:
-                f.write(json.dumps(towrite) + "\n")
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("]\n")
+            batch.append(example)
+            if len(batch) == CHECK_BATCHSIZE:
+                run_checks_batch(batch, llm, config, executor)
+                write_examples(batch)
+                batch = []
+        if batch:
+            run_checks_batch(batch, llm, config, executor)
+            write_examples(batch)
+        if is_array:
+            f.write(b"\n]\n")
+    logger.info(f"Read {n_inputs} queries from {config['input']}")
     logger.info(f"Wrote {n_outputs} examples to {config['output']}, {n_errors} errors")
     logger.info(f"Total cost: {total_cost}")
+    if config.get("response_cache") is not None:
+        cache = config["response_cache"]
+        logger.info(f"Checker-LLM response cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
 
 
 def main():
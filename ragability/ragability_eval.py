@@ -4,56 +4,105 @@
 Module for the CLI to create evaluation reports from a ragability_check output file.
 """
 
-import os, sys
+import os
 from typing import List, Dict, Optional
-import json
 import argparse
+import numpy as np
 import pandas as pd
-from pandas.core.frame import DataFrame
-import hjson
-import sklearn as sk
-from collections import defaultdict, Counter
+import orjson
+from collections import Counter
 from logging import DEBUG
-from ragability.logging import logger, set_logging_level, add_logging_file
-from ragability.data import read_input_file
+from ragability.logging import logger, set_logging_level
+from ragability.data import read_input_file, cached_read_input_file
 from ragability.utils import pp_config
 from ragability.checks import CHECKS
 
 
-def make_grouping_func(
+def make_tagsets(df: pd.DataFrame) -> pd.Series:
+    """
+    Split the comma-separated tags of each row of the dataframe into a frozenset of tags, so that the tags have to be
+    split only once for all the tag criteria. The tags are categorical, so each distinct value is only split once
+    and the sets are then picked for all rows by the category codes.
+    """
+    tags = df["tags"].astype("category")
+    # the code -1 of missing tags picks the last entry, the same set as for an empty tags string
+    tagsets = [frozenset(t.strip() for t in val.split(",")) for val in tags.cat.categories] + [frozenset([""])]
+    return pd.Series(np.array(tagsets, dtype=object)[tags.cat.codes.to_numpy()], index=df.index)
+
+
+def make_grouping_keys(
     df: pd.DataFrame,
     tags: Optional[List[str]] = None,
-    fields: Optional[List[str]] = None):
+    fields: Optional[List[str]] = None,
+    tagsets: Optional[pd.Series] = None) -> pd.Series:
     """
-    Create a function which can be used as an argument to the pandas group_by method on the given dataframe.
-    This creates a binary grouping where one group consists of all the rows that match the given tags and field values,
-    and another group which does not.
+    Create the group keys for all rows of the given dataframe, which can be used as an argument to the pandas
+    groupby method. For tags, this creates a binary grouping where one group consists of all the rows that have
+    all the given tags (key True) and another group which does not (key False). For fields, the key is the
+    comma-separated list of the field values of the row. The keys are computed for all rows at once.
+    The tagsets created with make_tagsets for the dataframe can be passed, if not they are created here.
     """
     # NOTE: for now this must be used for either tags or fields, not both
     assert not (tags and fields)
 
     # if both tags and fields are None or empty, raise and Exception
-    if tags is None and fields is None:
+    if not tags and not fields:
         raise Exception("No grouping criteria")
+    if tags:
+        if tagsets is None:
+            tagsets = make_tagsets(df)
+        tags = frozenset(tags)
+        return tagsets.map(tags.issubset)
+    keys = df[fields[0]]
+    if len(fields) > 1:
+        keys = keys.str.cat([df[fname] for fname in fields[1:]], sep=",")
+    return keys
+
 
-    def the_groupby_func(index):
-        row = df.loc[index]
-        if tags:
-            tag_values = [s.strip() for s in row["tags"].split(",")]
-            for t in tags:
-                if t not in tag_values:
-                    logger.debug(f"Tag {t} not in {tag_values} in {row} for groupby {tags}")
-                    return False
-            return True
-        elif fields:
-            keys = []
-            for fname in fields:
-                keys.append(row[fname])
-            groupname = ",".join(keys)
-            return groupname
-        else:
-            raise Exception("No grouping criteria")
-    return the_groupby_func
+def accuracy_rows(
+    df: pd.DataFrame,
+    groups: str | pd.Series,
+    metric: str,
+    key: str,
+    correct: Optional[pd.Series] = None,
+    missing: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    Create the "metric:accuracy" and "metric:n" rows of the long format evaluation report for each group and LLM in
+    the given dataframe. The accuracies and counts for all groups and LLMs are computed at once, taking the mean and
+    size of the correct results per group and LLM, and then melted to the rows of the report.
+    If a group and LLM has rows with a missing result, its accuracy is NaN and the rows are logged.
+
+    :param df: the dataframe with the target, result and llm columns
+    :param groups: the name of the group of all rows or a Series with the name of the group of each row, rows with a
+        missing group name are not part of any group
+    :param metric: the name of the metric
+    :param key: the "kind:metric" key of the dataframe, used in the error messages
+    :param correct: the boolean Series telling for each row if the result equals the target, computed if not given
+    :param missing: the boolean Series telling for each row if the result is missing, computed if not given
+    :return: a dataframe with the columns group, llm, metric and value
+    """
+    if correct is None:
+        correct = df["target"] == df["result"]
+    if missing is None:
+        missing = df["result"].isna()
+    if isinstance(groups, str):
+        groups = pd.Series(groups, index=df.index)
+    stats = pd.DataFrame({"correct": correct, "missing": missing}).groupby(
+        [groups.rename("group"), df["llm"]], observed=True, sort=False).agg(
+        accuracy=("correct", "mean"), n=("correct", "size"), missing=("missing", "any"))
+    for group, llm in stats.index[stats["missing"]]:
+        logger.error(f"Error: missing result values in calculating metric {metric} for {llm} in {key}")
+        # print the rows from the df where the result value is None or NaN and make sure all
+        # columns are printed properly! For this, we convert all the rows at once to dictionaries
+        # of column name / value pairs and print each dictionary in a separate line.
+        for idx, row in df[missing & (groups == group) & (df["llm"] == llm)].to_dict(orient="index").items():
+            logger.error(f"Row {idx}: {row}")
+    # set the accuracy to NaN if there is an error
+    stats["accuracy"] = stats["accuracy"].mask(stats["missing"])
+    rows = stats.reset_index().melt(
+        id_vars=["group", "llm"], value_vars=["accuracy", "n"], var_name="stat", value_name="value")
+    rows["metric"] = f"{metric}:" + rows["stat"]
+    return rows[["group", "llm", "metric", "value"]]
 
 
 def get_args():
@@ -73,6 +122,14 @@ def get_args():
                         help='List of tags or comma-separated taglists to evaluate by', required=False)
     parser.add_argument('--by_qfields', nargs="+", type=str,
                         help='List of query fields to evaluate by', required=False)
+    parser.add_argument("--nworkers", type=int, default=1,
+                        help="Number of worker processes for checking the entries of the input file, 0 for one per "
+                             "CPU (1)", required=False)
+    parser.add_argument("--cache", action="store_true",
+                        help="Keep the parsed input file in a cache in $XDG_CACHE_HOME/ragability (default "
+                             "~/.cache/ragability), so that reading the same unchanged file again is faster. Only the "
+                             "most recently used files are kept and the cache is only used if the directory is owned "
+                             "by the user and not writable by others", required=False)
     parser.add_argument("--debug", "-d", action="store_true", help="Debug mode", required=False)
     parser.add_argument("--debug-save-checkdfs", action="store_true", help="Save all the per-metric data frames", required=False)
     args_tmp = parser.parse_args()
@@ -81,79 +138,171 @@ def get_args():
     return args
 
 
-Q_STANDARD_FIELDS = ["qid", "tags", "llm", "facts", "query", "pids", "checks", "notes", "error", "response"]
-C_STANDARD_FIELDS = ["cid", "query", "func", "metrics", "result", "notes", "error", "response"]
+# the standard fields of the queries and checks, all other fields are added to the rows as they are
+Q_STANDARD_FIELDS = frozenset(["qid", "tags", "llm", "facts", "query", "pids", "checks", "notes", "error", "response"])
+C_STANDARD_FIELDS = frozenset(["cid", "query", "func", "metrics", "result", "notes", "error", "response"])
+# the columns which make_checkdfs adds to the check dataframe itself
+C_ADDED_FIELDS = frozenset(["_llm", "kind", "target"])
+# the fields which each row of the per-metric dataframes has, in column order
+ROW_STANDARD_FIELDS = ["target", "result", "qid", "tags", "llm", "func", "kind"]
+
+
+def write_csv(df: pd.DataFrame, path: str):
+    """
+    Write the dataframe to a csv file
+    """
+    df.to_csv(path, index=False)
+
+
+def write_tsv(df: pd.DataFrame, path: str):
+    """
+    Write the dataframe to a tsv file
+    """
+    df.to_csv(path, index=False, sep="\t")
+
+
+def write_json(df: pd.DataFrame, path: str):
+    """
+    Write the rows of the dataframe as an array of dicts to a json file
+    """
+    with open(path, "wb") as outfp:
+        outfp.write(orjson.dumps(df.to_dict(orient="records"), option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+def write_hjson(df: pd.DataFrame, path: str):
+    """
+    Write the rows of the dataframe as an array of dicts to a hjson file
+    """
+    # hjson is only needed for this output format, so it is only imported here
+    import hjson
+    with open(path, "wt") as outfp:
+        hjson.dump(df.to_dict(orient="records"), outfp)
+
+
+# the functions to write the report dataframes for each of the supported file extensions
+DF_WRITERS = {".csv": write_csv, ".tsv": write_tsv}
+JSON_WRITERS = {".json": write_json, ".hjson": write_hjson}
+
+
+def make_checkdfs(indata: List[Dict]):
+    """
+    Create one dataframe for each kind of check and metric from the entries of a ragability_check output file.
+    Each dataframe contains one row for each check of that kind which uses the metric, with the fields target,
+    result, qid, tags, llm, func and kind, any non-standard fields of the query and any non-standard fields of
+    the check, with the prefix "check_". Queries and checks with an error are skipped and counted.
+    The rows are created with a few vectorized pandas operations on the whole data instead of one dict per row,
+    first for the queries, then exploded to the checks and then to the metrics.
+
+    :param indata: the list of entries
+    :return: a tuple (checkdfs, n_errors, n_errors_per_llm, nc_errors, nc_errors_per_llm) where checkdfs is a dict
+        mapping "kind:metric" to the dataframe
+    """
+    qdf = pd.DataFrame(indata)
+    if "llm" not in qdf.columns:
+        qdf["llm"] = None
+    nollm = qdf.index[~qdf["llm"].astype(bool) | qdf["llm"].isna()]
+    if len(nollm):
+        idx = nollm[0]
+        raise ValueError(f"Error: Missing 'llm' field in entry with index {idx}: {indata[idx]}")
+    # skip and count the queries with an error
+    if "error" in qdf.columns:
+        qerror = qdf["error"].fillna("").astype(bool)
+    else:
+        qerror = pd.Series(False, index=qdf.index)
+    n_errors = int(qerror.sum())
+    n_errors_per_llm = Counter(qdf.loc[qerror, "llm"])
+    qdf = qdf[~qerror]
+    # one row per check, the index of each check row is the index of its query. Without any checks, there is
+    # nothing to evaluate
+    checks = qdf["checks"].explode().dropna() if "checks" in qdf.columns else pd.Series(dtype=object)
+    if checks.empty:
+        return {}, n_errors, n_errors_per_llm, 0, Counter()
+    cdf = pd.DataFrame(checks.tolist(), index=checks.index)
+    cdf["_llm"] = qdf.loc[cdf.index, "llm"]
+    # skip and count the checks with an error or with an unknown check function
+    if "error" in cdf.columns:
+        cerror = cdf["error"].fillna("").astype(bool)
+    else:
+        cerror = pd.Series(False, index=cdf.index)
+    # look up the kind and target of the check functions for all checks at once in a table with one row per
+    # check function, the kind is missing for unknown check functions
+    funcdefs = pd.DataFrame([(fdef["kind"], fdef["target"]) for fdef in CHECKS.values()],
+                            index=list(CHECKS), columns=["kind", "target"])
+    cdf["kind"] = cdf["func"].map(funcdefs["kind"])
+    unknown = ~cerror & cdf["kind"].isna()
+    for idx, func in cdf.loc[unknown, "func"].items():
+        logger.error(f"Check function {func} not found in check for qid {qdf.at[idx, 'qid']}")
+    cerror = cerror | unknown
+    nc_errors = int(cerror.sum())
+    nc_errors_per_llm = Counter(cdf.loc[cerror, "_llm"])
+    cdf = cdf[~cerror]
+    if cdf.empty:
+        return {}, n_errors, n_errors_per_llm, nc_errors, nc_errors_per_llm
+    cdf["target"] = cdf["func"].map(funcdefs["target"])
+    # one row per check and metric
+    cdf = cdf.explode("metrics")
+    # build the rows in the same column order as the fields were added to each row so far: the standard fields,
+    # the non-standard query fields and the non-standard check fields
+    qfields = [k for k in qdf.columns if k not in Q_STANDARD_FIELDS]
+    cfields = [k for k in cdf.columns if k not in C_STANDARD_FIELDS and k not in C_ADDED_FIELDS]
+    rows = pd.concat([
+        cdf[["target", "result"]],
+        qdf.loc[cdf.index, ["qid", "tags", "llm"]],
+        cdf[["func", "kind"]],
+        qdf.loc[cdf.index, qfields],
+        cdf[cfields].add_prefix("check_"),
+    ], axis=1)
+    rows["_metric"] = cdf["metrics"]
+    # the llm, tags, func and kind columns only have few distinct values, as categoricals they take much less
+    # memory and are grouped by their integer codes, all the dataframes share the same categories
+    for col in ("llm", "tags", "func", "kind"):
+        rows[col] = rows[col].astype("category")
+    # create the dataframes for each kind and metric, kinds and metrics in the order in which they occur first
+    checkdfs = {}
+    kinds = {kind: idx for idx, kind in enumerate(pd.unique(rows["kind"]))}
+    groups = sorted(rows.groupby(["kind", "_metric"], sort=False, observed=True), key=lambda g: kinds[g[0][0]])
+    for (kind, metric), groupdf in groups:
+        # only keep the non-standard columns which have a value in at least one of the rows of the group
+        groupdf = groupdf.drop(columns="_metric")
+        empty = [col for col in groupdf.columns[len(ROW_STANDARD_FIELDS):] if groupdf[col].isna().all()]
+        groupdf = groupdf.drop(columns=empty).reset_index(drop=True)
+        checkdfs[f"{kind}:{metric}"] = groupdf
+    return checkdfs, n_errors, n_errors_per_llm, nc_errors, nc_errors_per_llm
 
 
 def run(config: dict):
-    # read the input file and collect for each check the necessary fields
-    indata = read_input_file(config["input"])
-    checksdata = defaultdict(lambda: defaultdict(list))
-    # counter to count the queries with errors
-    n_errors = 0
-    n_errors_per_llm = Counter()
-    nc_errors = 0
-    nc_errors_per_llm = Counter()
-    n_rows = 0
-    for idx, q in enumerate(indata):
-        error = q.get("error")
-        llm = q.get("llm")
-        if not llm:
-            raise ValueError(f"Error: Missing 'llm' field in entry with index {idx}: {q}")
-        if error:
-            n_errors += 1
-            n_errors_per_llm[llm] += 1
-            continue
-        for check in q["checks"]:
-            error = check.get("error")
-            if error:
-                nc_errors += 1
-                nc_errors_per_llm[llm] += 1
-                continue
-            func = check["func"]
-            funcdef = CHECKS.get(func)
-            kind = funcdef["kind"]
-            if not funcdef:
-                logger.error(f"Check function {func} not found in check for qid {q['qid']}")
-                nc_errors += 1
-                nc_errors_per_llm[llm] += 1
-                continue
-            metrics = check["metrics"]
-            for metric in metrics:
-                row = dict(
-                    target=funcdef["target"],
-                    result=check["result"],
-                    qid=q["qid"],
-                    tags=q["tags"],
-                    llm=llm,
-                    func=func,
-                    kind=kind,
-                )
-                # add any non=standard fields from the query to the row
-                for k, v in q.items():
-                    if k not in Q_STANDARD_FIELDS:
-                        row[k] = v
-                # add any non-standard fields from the check to the row
-                for k, v in check.items():
-                    if k not in C_STANDARD_FIELDS:
-                        row[f"check_{k}"] = v
-                checksdata[kind][metric].append(row)
-                n_rows += 1
+    # find the function to write each of the output files from the file extensions first, so that an unsupported
+    # extension is reported before doing any work
+    writers = {}
+    for option, formats in (("save_longdf", DF_WRITERS), ("save_widedf", DF_WRITERS), ("save_json", JSON_WRITERS)):
+        if config.get(option):
+            ext = os.path.splitext(config[option])[1]
+            if ext not in formats:
+                raise Exception(f"Error: Output file must end in {' or '.join(formats)}, not {config[option]}")
+            writers[option] = formats[ext]
+    # read the input file and collect for each check the necessary fields, with --cache, the parsed input file
+    # is cached, so that evaluating the same file again, e.g. with different groupings, does not have to parse it again
+    nworkers = config.get("nworkers")
+    if nworkers is None:
+        nworkers = 1
+    elif nworkers == 0:
+        nworkers = os.cpu_count() or 1
+    if config.get("cache"):
+        indata = cached_read_input_file(config["input"], nworkers=nworkers)
+    else:
+        indata = read_input_file(config["input"], nworkers=nworkers)
+    checkdfs, n_errors, n_errors_per_llm, nc_errors, nc_errors_per_llm = make_checkdfs(indata)
     logger.debug(f"Errors in queries: {n_errors}")
     logger.debug(f"Errors in checks: {nc_errors}")
     logger.debug(f"Errors in queries per llm: {n_errors_per_llm}")
     logger.debug(f"Errors in checks per llm: {nc_errors_per_llm}")
-    logger.debug(f"Generated check data rows: {n_rows}")
-    # convert the checksdata to a dictionary of dataframes, one for each metric
-    checkdfs = {}
-    for kind, kinddata in checksdata.items():
-        for metric, metricdata in kinddata.items():
-            dftmp = pd.DataFrame(metricdata)
-            checkdfs[f"{kind}:{metric}"] = dftmp
-            logger.debug(f"Generated check data dataframe for {kind}:{metric} with {len(dftmp)} rows and {len(dftmp.columns)} columns")
-            # if --debug option is given, write the dataframe to a csv file
-            if config.get("debug-save-checkdfs"):
-                dftmp.to_csv(f"debug_checkdata_{kind}_{metric}.csv", index=False)
+    logger.debug(f"Generated check data rows: {sum(len(df) for df in checkdfs.values())}")
+    for key, dftmp in checkdfs.items():
+        kind, metric = key.split(":")
+        logger.debug(f"Generated check data dataframe for {kind}:{metric} with {len(dftmp)} rows and {len(dftmp.columns)} columns")
+        # if --debug option is given, write the dataframe to a csv file
+        if config.get("debug-save-checkdfs"):
+            dftmp.to_csv(f"debug_checkdata_{kind}_{metric}.csv", index=False)
     logger.debug(f"Generated check data dataframes: {len(checkdfs)} for keys {list(checkdfs.keys())}")
 
     # we have to generate an evaluation report dataframe of the following format:
@@ -165,71 +314,33 @@ def run(config: dict):
     # example:
     # group, llm, metric1:accuracy, metric1:n, metric2:accuracy, metric2:n
     #
-    # To prepare the data for this dataframe, collect the rows of the dataframe in list, where each row
-    # is a dictionary with all the necessary fields
+    # To prepare the data for this dataframe, collect the rows for each group and metric in a list of dataframes
+    # which are then concatenated
 
     dfrows = []
+    # whether the result of each row is correct or missing does not depend on the grouping, so it is only
+    # computed once for each dataframe and used for all the groupings
+    matches = {key: (df["target"] == df["result"], df["result"].isna()) for key, df in checkdfs.items()}
     # first of all, create the entries without any grouping, just by LLMs for all the metrics
     for key, df in checkdfs.items():
         kind, metric = key.split(":")
-        for llm, llmgroup in df.groupby("llm"):
-            try:
-                score_value = sk.metrics.accuracy_score(llmgroup["target"].values, llmgroup["result"].values)
-            except Exception as e:
-                logger.error(f"Error: {e} in calculating metric {metric} for {llm} in {key}")
-                # print the rows from the df where the result value is None or NaN and make sure all
-                # columns are printed properly! For this, we need to convert each row to a dictionary
-                # of column name / value pairs and print each dictionary in a separate line.
-                for idx, row in llmgroup.iterrows():
-                    # only print the rows where the result is None or NaN
-                    if row["result"] is None or row["result"] != row["result"]:
-                        logger.error(f"Row {idx}: {dict(row)}")
-                # set it to NaN if there is an error
-                score_value = float("nan")
-            dfrows.append(dict(
-                group="all",
-                llm=llm,
-                metric=f"{metric}:accuracy",
-                value=score_value
-            ))
-            dfrows.append(dict(
-                group="all",
-                llm=llm,
-                metric=f"{metric}:n",
-                value=len(llmgroup)
-            ))
-    logger.debug(f"Generated {len(dfrows)} rows for all LLMs")
+        dfrows.append(accuracy_rows(df, "all", metric, key, *matches[key]))
+    logger.debug(f"Generated {sum(len(rows) for rows in dfrows)} rows for all LLMs")
 
     # for eachof the tag names mentioned in the config "by_tags" parameter, create a group for all rows
     # which do have the tag, labeling with the group name "tagname:yes" and for all rows which do not have the tag
     # labeling with the group name "tagname:no". For each of these groups, create the same metrics as for the "all"
     # group.
     if config.get("by_tags"):
+        # the tags of each dataframe are only split once for all the tag names
+        tagsets = {key: make_tagsets(df) for key, df in checkdfs.items()}
         for tagname in config.get("by_tags"):
             logger.debug(f"Generating rows for grouping by tag {tagname}")
+            groupnames = {True: f"{tagname}:yes", False: f"{tagname}:no"}
             for key, df in checkdfs.items():
-                grouping_func = make_grouping_func(df, tags=[tagname])
                 kind, metric = key.split(":")
-                grouped = df.groupby(grouping_func)
-                for group, groupdf in grouped:
-                    logger.debug(f"Grouping {key} by tag {tagname} and group {group}")
-                    if group:
-                        groupname = f"{tagname}:yes"
-                    else:
-                        groupname = f"{tagname}:no"
-                    for llm, llmgroup in groupdf.groupby("llm"):
-                        dfrows.append(dict(
-                            group=groupname,
-                            llm=llm,
-                            metric=f"{metric}:accuracy",
-                            value=sk.metrics.accuracy_score(llmgroup["target"].values, llmgroup["result"].values)
-                        ))
-                        dfrows.append(dict(
-                            group=groupname,
-                            llm=llm,
-                            metric=f"{metric}:n",
-                            value=len(llmgroup)
-                        ))
+                groups = make_grouping_keys(df, tags=[tagname], tagsets=tagsets[key]).map(groupnames)
+                dfrows.append(accuracy_rows(df, groups, metric, key, *matches[key]))
 
     # for each of the field names mentioned in the config "by_qfields" parameter, find all the different
     # values of the field in the dataframe and create a group for each of these values, labeling with the group name
@@ -239,63 +350,39 @@ def run(config: dict):
         for fieldname in config.get("by_qfields"):
             logger.debug(f"Generating rows for grouping by field {fieldname}")
             for key, df in checkdfs.items():
-                grouping_func = make_grouping_func(df, fields=[fieldname])
                 kind, metric = key.split(":")
-                grouped = df.groupby(grouping_func)
-                for group, groupdf in grouped:
-                    logger.debug(f"Grouping {key} by field {fieldname} and group {group}")
-                    if group:
-                        groupname = f"{fieldname}:{group}"
-                    else:
-                        groupname = f"{fieldname}:no"
-                    for llm, llmgroup in groupdf.groupby("llm"):
-                        dfrows.append(dict(
-                            group=groupname,
-                            llm=llm,
-                            metric=f"{metric}:accuracy",
-                            value=sk.metrics.accuracy_score(llmgroup["target"].values, llmgroup["result"].values)
-                        ))
-                        dfrows.append(dict(
-                            group=groupname,
-                            llm=llm,
-                            metric=f"{metric}:n",
-                            value=len(llmgroup)
-                        ))
-
-    logger.debug(f"Generated {len(dfrows)} rows in total")
-    # re-order the rows and sort by group, llm, metric
-    dfrows = sorted(dfrows, key=lambda x: (x["group"], x["llm"], x["metric"]))
-
-    # create the long format dataframe from the list of rows
-    dfout_long = pd.DataFrame(dfrows)
+                keys = make_grouping_keys(df, fields=[fieldname])
+                # rows without a value for the field are not part of any group
+                groupnames = {value: f"{fieldname}:{value}" if value else f"{fieldname}:no"
+                              for value in keys.dropna().unique()}
+                dfrows.append(accuracy_rows(df, keys.map(groupnames), metric, key, *matches[key]))
+
+    logger.debug(f"Generated {sum(len(rows) for rows in dfrows)} rows in total")
+    # create the long format dataframe from the rows and sort by group, llm, metric
+    if dfrows:
+        dfout_long = pd.concat(dfrows, ignore_index=True)
+    else:
+        dfout_long = pd.DataFrame(columns=["group", "llm", "metric", "value"])
+    dfout_long = dfout_long.sort_values(["group", "llm", "metric"], kind="stable", ignore_index=True)
     logger.debug(f"Generated long format dataframe with {len(dfout_long)} rows and {len(dfout_long.columns)} columns")
-    if config.get("save_longdf"):
-        if config["save_longdf"].endswith(".csv"):
-            dfout_long.to_csv(config["save_longdf"], index=False)
-        elif config["save_longdf"].endswith(".tsv"):
-            dfout_long.to_csv(config["save_longdf"], index=False, sep="\t")
-        else:
-            raise Exception(f"Error: Output file must end in .csv or .tsv, not {config['save-longdf']}")
-    # now pivot the long format dataframe to the wide format
-    dfout = dfout_long.pivot_table(index=["group", "llm"], columns="metric", values="value")
+    if "save_longdf" in writers:
+        writers["save_longdf"](dfout_long, config["save_longdf"])
+    # now reshape the long format dataframe to the wide format. Usually there is exactly one value for each group,
+    # llm and metric, so nothing has to be aggregated, but if checks of different kinds use the same metric name,
+    # the values are averaged, like pivot_table does it
+    values = dfout_long.set_index(["group", "llm", "metric"])["value"]
+    if values.index.has_duplicates:
+        logger.warning("Warning: Several values for the same group, llm and metric, e.g. because checks of different "
+                       "kinds use the same metric name, using the mean in the wide format report")
+        values = values.astype(float).groupby(level=["group", "llm", "metric"], sort=True).mean()
+    # metrics without any value in any row (e.g. only NaN accuracies) are left out
+    dfout = values.unstack("metric").dropna(axis=1, how="all")
     dfout.reset_index(inplace=True)
-    if config.get("save_widedf"):
-        if config["save_widedf"].endswith(".csv"):
-            dfout.to_csv(config["save_widedf"], index=False)
-        elif config["save_widedf"].endswith(".tsv"):
-            dfout.to_csv(config["save_widedf"], index=False, sep="\t")
-        else:
-            raise Exception(f"Error: Output file must end in .csv or .tsv, not {config['save_widedf']}")
-    # if the output file is specified, save the dataframe as csv or tsv depending on the extension or
-    # save a dictionary representation of the dataframe as json or hjson
-    if config.get("save_json"):
-        if config["save_json"].endswith(".json"):
-            dfout.to_json(config["save_json"], orient="records")
-        elif config["save_json"].endswith(".hjson"):
-            with open(config["save_json"], "wt") as outfp:
-                hjson.dump(dfout.to_dict(orient="records"), outfp)
-        else:
-            raise Exception(f"Error: Output file must end in .csv, .tsv, .json or .hjson, not {config['output']}")
+    if "save_widedf" in writers:
+        writers["save_widedf"](dfout, config["save_widedf"])
+    # if the output file is specified, save a dictionary representation of the dataframe as json or hjson
+    if "save_json" in writers:
+        writers["save_json"](dfout, config["save_json"])
     # if verbose is set, or no output file is specified, write the results to stdout using textual formattign of
     # the dataframe
     if config.get("verbose") or not config.get("save-json"):
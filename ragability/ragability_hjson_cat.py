@@ -4,20 +4,12 @@
 Module for the CLI to concatenate several json or hjson files into one.
 """
 
-import os, sys
-from typing import List, Dict, Optional
-import json
 import argparse
-import pandas as pd
-from pandas.core.frame import DataFrame
-import hjson
-import sklearn as sk
-from collections import defaultdict, Counter
+import orjson
 from logging import DEBUG
-from ragability.logging import logger, set_logging_level, add_logging_file
-from ragability.data import read_input_file
+from ragability.logging import logger, set_logging_level
+from ragability.data import iter_input_file
 from ragability.utils import pp_config
-from ragability.checks import CHECKS
 
 
 def get_args():
@@ -25,7 +17,7 @@ def get_args():
     Get the command line arguments
     """
     parser = argparse.ArgumentParser(description='Concatenate json, hjson, jsonl into one file')
-    parser.add_argument('--input', '-i', nargs="=", type=str, help='One or more json, hjson, jsonl files', required=True)
+    parser.add_argument('--input', '-i', nargs="+", type=str, help='One or more json, hjson, jsonl files', required=True)
     parser.add_argument('--output', '-o', type=str,
                         help='Output file, hjson, json or jsonl', required=True)
     parser.add_argument('--debug', '-d', action='store_true', help='Debug mode')
@@ -36,24 +28,35 @@ def get_args():
 
 
 def run(config: dict):
-    # read each of the input files in turn and write all the entries of each file to the output file
+    # read each of the input files in turn and write all the entries of each file to the output file, jsonl files
+    # are read one entry at a time, so only the entries of one json or hjson input file are kept in memory.
+    # For json and hjson output, the entries of all files are written as the elements of a single array.
+    # check all the file extensions first, so that we do not fail after having written part of the output
+    for input_file in config['input']:
+        if not input_file.endswith((".jsonl", ".json", ".hjson", ".yaml")):
+            raise Exception(f"Error: Unknown file extension for input file {input_file}")
+    if not config['output'].endswith((".jsonl", ".json", ".hjson")):
+        raise Exception(f"Error: Output file must end in .jsonl, .json or .hjson, not {config['output']}")
     n_total = 0
-    with open(config['output'], 'w') as f:
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("[\n")
-        for idx, input_file in enumerate(config['input']):
-            data = read_input_file(config["input"])
-            n_total += len(data)
-            logger.debug(f"Read {len(data)} entries from {input_file}")
-            if idx > 0:
-                f.write(",\n")
-            if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-                f.write(json.dumps(data, indent=4))
-            else:
-                for entry in data:
-                    f.write(json.dumps(entry) + "\n")
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("\n]\n")
+    is_array = config['output'].endswith(".json") or config['output'].endswith(".hjson")
+    if is_array:
+        serialize = lambda entry: orjson.dumps(entry, option=orjson.OPT_INDENT_2)
+    else:
+        serialize = lambda entry: orjson.dumps(entry) + b"\n"
+    with open(config['output'], 'wb') as f:
+        if is_array:
+            f.write(b"[\n")
+        for input_file in config['input']:
+            n_entries = 0
+            for entry in iter_input_file(input_file):
+                if is_array and n_total:
+                    f.write(b",\n")
+                f.write(serialize(entry))
+                n_entries += 1
+                n_total += 1
+            logger.debug(f"Read {n_entries} entries from {input_file}")
+        if is_array:
+            f.write(b"\n]\n")
     logger.info(f"Written {n_total} entries to {config['output']}")
 
 
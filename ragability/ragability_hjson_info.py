@@ -5,10 +5,11 @@ Module for the CLI to concatenate several json or hjson files into one.
 """
 
 import argparse
+import itertools
 from collections import Counter
 from logging import DEBUG
 from ragability.logging import logger, set_logging_level
-from ragability.data import read_input_file
+from ragability.data import read_input_file, cached_read_input_file
 from ragability.utils import pp_config
 
 
@@ -18,6 +19,11 @@ def get_args():
     """
     parser = argparse.ArgumentParser(description='Show information about the contents of a hjsonm json or jsonl file')
     parser.add_argument('--input', '-i', type=str, help='One or more json, hjson, jsonl files', required=True)
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep the parsed input file in a cache in $XDG_CACHE_HOME/ragability (default '
+                             '~/.cache/ragability), so that reading the same unchanged file again is faster. Only the '
+                             'most recently used files are kept and the cache is only used if the directory is owned '
+                             'by the user and not writable by others')
     parser.add_argument('--debug', '-d', action='store_true', help='Debug mode')
     args_tmp = parser.parse_args()
     args = {}
@@ -27,7 +33,10 @@ def get_args():
 
 def run(config: dict):
     # read each of the input files in turn and write all the entries of each file to the output file
-    data = read_input_file(config["input"])
+    if config.get("cache"):
+        data = cached_read_input_file(config["input"])
+    else:
+        data = read_input_file(config["input"])
     # show the following information: number of entries, and all the keys that are present in the entries
     # and how many times each key is present. Also if there are nested keys, e.g. "a.b.c.d" show these as well.
     # Dictionaries can be nested arbitrarily.
@@ -39,15 +48,26 @@ def run(config: dict):
     query_cost = 0
     checking_cost = 0
     have_cost = False
-    def count_keys(entry, prefix=""):
-        for k, v in entry.items():
-            keys[prefix + k] += 1
-            if isinstance(v, dict):
-                count_keys(v, prefix + k + ".")
-            elif isinstance(v, list):
-                for idx, item in enumerate(v):
-                    if isinstance(item, dict):
-                        count_keys(item, prefix + k + f"[{idx}].")
+    def count_keys(entry):
+        # walk the nested dicts with an explicit stack of (prefix, iterator over the remaining items), so that the keys
+        # are counted in the same order as when visiting the nested dicts recursively. The keys of all the dicts in a
+        # list share the same prefix a.b[]. so that the number of different keys does not grow with the list lengths.
+        stack = [("", iter(entry.items()))]
+        while stack:
+            prefix, items = stack[-1]
+            for k, v in items:
+                key = prefix + k
+                keys[key] += 1
+                if isinstance(v, dict):
+                    stack.append((key + ".", iter(v.items())))
+                    break
+                if isinstance(v, list):
+                    dicts = [item.items() for item in v if isinstance(item, dict)]
+                    if dicts:
+                        stack.append((key + "[].", itertools.chain.from_iterable(dicts)))
+                        break
+            else:
+                stack.pop()
 
     for entry in data:
         count_keys(entry)
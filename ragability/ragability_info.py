@@ -2,10 +2,10 @@
 """
 Command to print system information and package versions.
 """
-import importlib
+import re
 import os, sys
 import argparse
-from importlib.metadata import version
+from importlib.metadata import distributions
 from ragability.version import __version__ as raga_version
 
 PACKAGES = """
@@ -20,6 +20,27 @@ ollama
 scikit-learn
 """
 
+def normalize_name(name):
+    """
+    Normalize the distribution name, so that e.g. scikit_learn and Scikit-Learn are the same.
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def get_versions():
+    """
+    Get the versions of all installed distributions with a single pass over the distribution metadata, as a dict
+    mapping the normalized name to the version. If a distribution is installed more than once, the version of the
+    first one found on the path is used, as with importlib.metadata.version.
+    """
+    versions = {}
+    for dist in distributions():
+        name = dist.metadata["Name"]
+        if name:
+            versions.setdefault(normalize_name(name), dist.version)
+    return versions
+
+
 def get_args():
     aparser = argparse.ArgumentParser(description="Show various system info")
     aparser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
@@ -39,12 +60,13 @@ def main():
         print(f"Operating system: {os.uname()}")
     print(f"Python platform: {sys.platform}")
     print("Package versions:")
+    versions = get_versions()
     for p in sorted(PACKAGES.split()):
-        try:
-            v = version(p)
+        v = versions.get(normalize_name(p))
+        if v is not None:
             print(f"{p}: {v}")
-        except Exception as ex:
-            print(f"!!! {p}: NOT INSTALLED/CANNOT IMPORT !!! {ex}")
+        else:
+            print(f"!!! {p}: NOT INSTALLED/CANNOT IMPORT !!! No package metadata was found for {p}")
 
 
 if __name__ == "__main__":
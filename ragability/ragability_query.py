@@ -4,18 +4,41 @@
 Module to run a bunch of ragability queries and get the responses.
 """
 
-import json
+import os
 import argparse
 import re
+import time
+import random
 import datetime
-import hjson
-from collections import Counter
+import asyncio
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from collections import defaultdict
 from logging import DEBUG
 from ragability.logging import logger, set_logging_level, add_logging_file
 from ragability.data import read_input_file, read_prompt_file
-from llms_wrapper.config import read_config_file, update_llm_config
-from llms_wrapper.llms import LLMS, ROLES
 from ragability.utils import pp_config
+from ragability.ratelimit import RateLimiter
+from ragability.cache import ResponseCache
+from ragability.progress import ProgressFile
+# llms_wrapper and hjson take a long time to import, so they are only imported where they are needed, which keeps
+# e.g. --help and errors in the arguments fast
+if TYPE_CHECKING:
+    from llms_wrapper.llms import LLMS
+
+# the minimum and maximum time in seconds to wait before retrying a failed query
+RETRY_MIN_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# the variables in the prompt templates and in the fact templates
+_PROMPT_VAR_RE = re.compile(r"(\$\{facts\}|\$\{query\})")
+_FACT_VAR_RE = re.compile(r"(\$\{fact\}|\$\{n\})")
+# the format of the LLM names given on the command line, provider/model
+_LLM_RE = re.compile(r"[a-zA-Z0-9_\-./]+/.+")
+# the size of the write buffer of the output file
+OUTPUT_BUFSIZE = 1 << 20
+# the suffix added to the output file name for the progress file of a run
+PROGRESS_SUFFIX = ".progress.jsonl"
 
 
 def get_args():
@@ -31,12 +54,35 @@ def get_args():
     parser.add_argument("--dry-run", "-n", action="store_true", help="Dry run, do not actually run the queries", required=False)
     parser.add_argument("--all", "-a", action="store_true", help="Run all queries, even if they have a response", required=False)
     parser.add_argument("--logfile", "-f", type=str, help="Log file", required=False)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of queries to run at the same time for each LLM (1)", required=False)
+    parser.add_argument("--nworkers", type=int, default=1,
+                        help="Number of worker processes for checking the entries of the input file, 0 for one per "
+                             "CPU (1)", required=False)
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse the LLM response for identical queries", required=False)
+    parser.add_argument("--cachefile", type=str,
+                        help="Sqlite file to keep the LLM response cache in between runs (implies --cache)",
+                        required=False)
+    parser.add_argument("--rate-limit", type=float,
+                        help="Maximum number of queries per minute for each LLM provider, the config can also have "
+                             "a \"rate_limits\" dict with the limit for specific providers (no limit)", required=False)
+    parser.add_argument("--retries", type=int, default=0,
+                        help="Number of times to retry a query which failed, with an exponential backoff (0)",
+                        required=False)
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the progress file of an earlier interrupted run with the same output file and "
+                             "run all queries again", required=False)
+    parser.add_argument("--pretty", action="store_true",
+                        help="Indent the entries of a json output file, by default each entry is written on one line",
+                        required=False)
     parser.add_argument("--debug", "-d", action="store_true", help="Debug mode", required=False)
     parser.add_argument("--verbose", "-v", action="store_true", help="Be more verbose and inform what is happening", required=False)
     args_tmp = parser.parse_args()
-    for llm in args_tmp.llms:
-        if not re.match(r"^[a-zA-Z0-9_\-./]+/.+$", llm):
-            raise Exception(f"Error: 'llm' field must be in the format 'provider/model' in line: {llm}")
+    bad = [llm for llm in args_tmp.llms if not _LLM_RE.fullmatch(llm)]
+    if bad:
+        raise Exception(f"Error: 'llm' field must be in the format 'provider/model' in line: {', '.join(bad)}")
+    from llms_wrapper.config import read_config_file, update_llm_config
     # convert the argparse object to a dictionary
     tmp = {}
     tmp.update(vars(args_tmp))
@@ -55,7 +101,7 @@ def get_args():
         oldllms = config.get("llms", [])
         config.update(args)
         # add the llms from the args to the llms from the config, but only if the llms is not already in the config
-        mentionedllm = [llm if isinstance(llm, str) else llm["llm"] for llm in config["llms"]]
+        mentionedllm = {llm if isinstance(llm, str) else llm["llm"] for llm in config["llms"]}
         for llm in args["llms"]:
             if llm not in mentionedllm:
                 oldllms.append(llm)
@@ -75,16 +121,196 @@ def get_args():
     if not args["promptfile"]:
         parser.print_help()
         raise Exception("Error: Must specify promptfile")
+    if not os.path.exists(args["input"]):
+        raise Exception(f"Error: Input file {args['input']} does not exist")
     args["prompt"] = read_prompt_file(args["promptfile"])
     # update the llm configuration in the args dict
     update_llm_config(args)
     return args
 
 
+def compile_template(text: str, var_re: re.Pattern):
+    """
+    Compile the template text to a function which replaces the variables matched by the regular expression with
+    their values. The text is split into the literal parts and the variables only once, rendering then just joins
+    the parts with the values of the variables.
+
+    :param text: the template text
+    :param var_re: the regular expression with one group which matches the variables
+    :return: a function which takes a dict mapping each variable, e.g. "${query}", to its value and returns the text
+    """
+    parts = var_re.split(text)
+    if len(parts) == 1:
+        return lambda values: text
+
+    def render(values):
+        out = parts.copy()
+        for idx in range(1, len(out), 2):
+            out[idx] = values[out[idx]]
+        return "".join(out)
+    return render
+
+
+def compile_prompt(prompt_tmpl: dict):
+    """
+    Compile the prompt template to a function which creates the prompt for a query, by replacing the facts and query
+    variables in the prompt text for each of the roles. If the query has no facts, the facts variable is left as it
+    is. If the template has a "fact" template, each fact is formatted with it, otherwise the facts are joined with
+    newlines.
+
+    :param prompt_tmpl: the prompt template
+    :return: a function which takes the query entry with the query and the facts and returns the prompt. The function
+        optionally takes a dict as second argument in which the formatted facts of the query are cached by fact
+        template, so that prompts of the same query with the same fact template share the formatted facts
+    """
+    from llms_wrapper.llms import ROLES
+    roles = {role: compile_template(content, _PROMPT_VAR_RE) for role, content in prompt_tmpl.items() if role in ROLES}
+    facttmpl = prompt_tmpl.get("fact")
+    fact_render = compile_template(facttmpl, _FACT_VAR_RE) if facttmpl else None
+    # the fields of the template in order, with the render function for the roles and None for all other fields,
+    # which are used unchanged, so the prompt is created in one step and the template is never copied or changed
+    fields = [(name, roles.get(name), value) for name, value in prompt_tmpl.items()]
+
+    def render(query, facts_cache=None):
+        if facts_cache is not None and facttmpl in facts_cache:
+            factsfmt = facts_cache[facttmpl]
+        else:
+            factsfmt = format_facts(query)
+            if facts_cache is not None:
+                facts_cache[facttmpl] = factsfmt
+        values = {"${facts}": factsfmt, "${query}": query["query"]}
+        return {name: value if role_render is None else role_render(values) for name, role_render, value in fields}
+
+    def format_facts(query):
+        facts = query.get("facts")
+        if facts is None:
+            pass
+        elif facts == []:
+            facts = None
+        elif isinstance(facts, str):
+            facts = [facts]
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(f"Got facts list {facts}")
+        if facts is None:
+            factsfmt = "${facts}"
+        elif fact_render is not None:
+            factsfmt = "".join(fact_render({"${fact}": fact, "${n}": str(idx+1)}) for idx, fact in enumerate(facts))
+        else:
+            factsfmt = "\n".join(facts)
+        return factsfmt
+    return render
+
+
+def run_query(llms: "LLMS", llmname: str, query: dict, pid: str, prompt: dict, messages: list, config: dict) -> dict:
+    """
+    Query the LLM with the messages for the query and prompt, or only log what would be done for a dry run.
+    This only logs and does not update any counts, so that it can be run in several threads at the same time.
+
+    :param llms: the LLMS object
+    :param llmname: the alias of the LLM to query
+    :param query: the query entry
+    :param pid: the id of the prompt
+    :param prompt: the prompt, used for logging
+    :param messages: the messages to send to the LLM
+    :param config: the configuration
+    :return: the entry to write to the output file, a copy of the query entry with the response, error, pid, llm
+        and cost fields set
+    """
+    if config['dry_run']:
+        logger.info("Would query LLM %s with prompt %s for query %s", llmname, prompt['pid'], query['qid'])
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Messages: %r", messages)
+        response = ""
+        error = "NOT RUN: DRY-RUN"
+        cost = 0
+    else:
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Messages: %r", messages)
+        # if we have a cached response for the same messages, use it instead of querying the LLM again
+        cache = config.get("response_cache")
+        key = None
+        cached = None
+        if cache is not None:
+            key = cache.make_key(llmname, messages, llms[llmname]["llm"])
+            cached = cache.get(key)
+        if cached is not None:
+            logger.debug("Using cached response of LLM %s for query %s", llmname, query['qid'])
+            response = cached
+            error = ""
+            cost = 0
+        else:
+            # the messages logged for each query are only formatted if the level is enabled
+            log = logger.info if config['verbose'] else logger.debug
+            log("Querying LLM %s with prompt %s for query %s", llmname, prompt['pid'], query['qid'])
+            # if a rate limit is configured for the provider of the LLM, wait for the next free slot before each query,
+            # a failed query is retried up to config["retries"] times, waiting a random time which grows exponentially
+            # with each retry
+            limiter = config.get("rate_limiters", {}).get(llmname)
+            retries = config.get("retries") or 0
+            cost = 0
+            for attempt in range(retries + 1):
+                if limiter is not None:
+                    limiter.acquire()
+                ret = llms.query(llmname, messages=messages, return_cost=True, debug=config['debug'])
+                response = ret.get("answer", "")
+                error = ret.get("error", "")
+                cost += ret.get("cost", 0)
+                if not error or attempt == retries:
+                    break
+                delay = random.uniform(RETRY_MIN_DELAY, min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** attempt))
+                logger.warning(f"Error querying LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}, retrying in {delay:.1f}s: {error}")
+                time.sleep(delay)
+            if cache is not None and not error:
+                cache.put(key, response, cost)
+        if error:
+            logger.warning(f"Error querying LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}: {error}")
+    # the output entry is built in one step instead of copying the query entry and then setting each field, the
+    # fields already in the query keep their position, the others are added at the end
+    return {**query, "response": response, "error": error, "pid": pid, "llm": llmname, "cost": cost}
+
+
+async def run_queries_async(todo: list, llms: "LLMS", config: dict, on_result=None) -> list:
+    """
+    Run all the given queries, at most config["concurrency"] at the same time for each LLM. Each LLM has its own
+    limit, so that a slow or rate limited LLM does not keep the queries for the other LLMs waiting, and the total
+    time is that of the slowest LLM instead of the sum for all LLMs. The LLM API is synchronous, so each query is run
+    in a thread, which is fine since the time is spent waiting for the LLM responses.
+
+    :param todo: a list of (llmname, query, pid, prompt, messages) tuples
+    :param llms: the LLMS object
+    :param config: the configuration
+    :param on_result: if not None, a function which is called with each entry as soon as it is available, in the
+        thread running the event loop
+    :return: the list of entries to write, in the order of the todo list
+    """
+    concurrency = max(1, config.get("concurrency") or 1)
+    sems = {}
+    for item in todo:
+        if item[0] not in sems:
+            sems[item[0]] = asyncio.Semaphore(concurrency)
+    # the default executor may have fewer threads than the concurrency we want
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency * max(1, len(sems))))
+
+    async def bounded(item):
+        async with sems[item[0]]:
+            towrite = await asyncio.to_thread(run_query, llms, *item, config)
+        if on_result is not None:
+            on_result(towrite)
+        return towrite
+
+    return await asyncio.gather(*[bounded(item) for item in todo])
+
+
 def run(config: dict):
     # read the input file into memory, we do not expect it to be too large and we want to check the format
     # of all json lines
-    inputs = read_input_file(config["input"])
+    from llms_wrapper.llms import LLMS
+    nworkers = config.get("nworkers")
+    if nworkers is None:
+        nworkers = 1
+    elif nworkers == 0:
+        nworkers = os.cpu_count() or 1
+    inputs = read_input_file(config["input"], nworkers=nworkers)
     llms = LLMS(config)
     llmnames = llms.list_aliases()
     logger.info(f"LLMs to use: {llmnames}")
@@ -101,104 +327,139 @@ def run(config: dict):
     if not config['output'].endswith(".json") and not config['output'].endswith(".jsonl") and not config['output'].endswith(".hjson"):
         raise Exception(f"Error: Output file must end in .json, .jsonl or .hjson, not {config['output']}")
     prompt_idx = {p["pid"]: idx for idx, p in enumerate(config["prompt"])}
+    # each prompt template is compiled only once
+    prompt_renders = {p["pid"]: compile_prompt(p) for p in config["prompt"]}
+    # create one rate limiter for each provider which has a rate limit, the provider is the part of the
+    # "provider/model" name before the slash and all the LLMs of the same provider share the limiter
+    rate_limits = config.get("rate_limits") or {}
+    limiters = {}
+    config["rate_limiters"] = {}
+    for llmname in llmnames:
+        provider = llms[llmname]["llm"].split("/", 1)[0]
+        qpm = rate_limits.get(provider, config.get("rate_limit"))
+        if qpm:
+            if provider not in limiters:
+                logger.info(f"Limiting the queries for provider {provider} to {qpm} per minute")
+                limiters[provider] = RateLimiter(qpm)
+            config["rate_limiters"][llmname] = limiters[provider]
+    if config.get("cache") or config.get("cachefile"):
+        config["response_cache"] = ResponseCache(config.get("cachefile"))
     n_llm_errors = 0
     n_outputs = 0
     total_cost = 0
-    cost_per_llm = Counter()
-    with open(config['output'], 'w') as f:
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("[\n")
-        for llmname in llmnames:
-            for query in inputs:
-                # if we have the field "pid" in the query, we use just that prompt, otherwise,
-                # if we have the field "pids" in the query, we iterate over those prompts, otherwise we use all prompts
-                # defined in the config
-                # NOTE: the field "pid" is put into the output of a processed query, which makes it possible to
-                # reprocess the output file with the same prompt
-                if "pid" in query:
-                    pids = [query["pid"]]
-                elif "pids" in query:
-                    pids = query["pids"]
-                else:
-                    pids = prompt_idx.keys()
-                for pid in pids:
-                    prompt_tmpl = config["prompt"][prompt_idx[pid]]
-                    logger.debug(f"Processing prompt {pid}")
-                    # if the response is already in the query and there is no or an empty error,
-                    # skip unless the option --all is give
-                    if not config['all'] and query.get("response") is not None and not query.get("error"):
-                        logger.debug(f"Skipping query {query['qid']} with response")
-                        continue
-                    prompt = prompt_tmpl.copy()
-                    logger.debug(f"Processing query {query['qid']}")
-                    if query.get("response"):     # we already have a response, skip
-                        logger.debug(f"Skipping query {query['qid']} with response")
-                        continue
-                    # replace facts and query variables in the prompt
-                    facts = query.get("facts")
-                    if facts is None:
-                        pass
-                    elif facts == []:
-                        facts = None
-                    elif isinstance(facts, str):
-                        facts = [facts]
-                    logger.debug(f"Got facts list {facts}")
-                    for role, content in prompt.items():
-                        if role in ROLES:
-                            if facts is not None:
-                                facttmpl = prompt.get("fact")
-                                if facttmpl:
-                                    factsfmt = []
-                                    for idx, fact in enumerate(facts):
-                                        factsfmt.append(facttmpl.replace("${fact}", fact).replace("${n}", str(idx+1)))
-                                    factsfmt = "".join(factsfmt)
-                                else:
-                                    factsfmt = "\n".join(facts)
-                                prompt[role] = content.replace("${facts}", factsfmt)
-                            prompt[role] = prompt[role].replace("${query}", query["query"])
-                    messages = llms.make_messages(prompt=prompt)
-                    if config['dry_run']:
-                        logger.info(f"Would query LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}")
-                        logger.debug(f"Messages: {messages}")
-                        response = ""
-                        error = "NOT RUN: DRY-RUN"
-                    else:
-                        if config['verbose']:
-                            logger.info(f"Querying LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}")
-                        else:
-                            logger.debug(f"Querying LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}")
-                        logger.debug(f"Messages: {messages}")
-                        ret = llms.query(llmname, messages=messages, return_cost=True, debug=config['debug'])
-                        response = ret.get("answer", "")
-                        error = ret.get("error", "")
-                        cost = ret.get("cost", 0)
-                        total_cost += cost
-                        cost_per_llm[llmname] += cost
-                        if error:
-                            logger.warning(f"Error querying LLM {llmname} with prompt {prompt['pid']} for query {query['qid']}: {error}")
-                            n_llm_errors += 1
-
-                    towrite = query.copy()
-                    towrite["response"] = response
-                    towrite["error"] = error
-                    towrite["pid"] = pid
-                    towrite["llm"] = llmname
-                    towrite["cost"] = cost
-                    n_outputs += 1
-                    if config['output'].endswith(".json"):
-                        f.write(json.dumps(towrite, indent=2) + "\n")
-                    elif config['output'].endswith(".hjson"):
-                        f.write(hjson.dumps(towrite, indent=2) + "\n")
-                    else:
-                        f.write(json.dumps(towrite) + "\n")
-        if config['output'].endswith(".json") or config['output'].endswith(".hjson"):
-            f.write("]\n")
+    cost_per_llm = defaultdict(float)
+    # first find all the queries to run and create the messages for each of them. The messages do not depend on
+    # the LLM, so they are only created once and then used for each of the LLMs
+    # queries which already have a response are filtered out before building the messages: if the response is
+    # already in the query and there is no or an empty error, skip unless the option --all is given, and always
+    # skip queries with a non-empty response
+    debug = logger.isEnabledFor(DEBUG)
+    torun = []
+    for query in inputs:
+        if query.get("response") or (not config['all'] and query.get("response") is not None and not query.get("error")):
+            if debug:
+                logger.debug(f"Skipping query {query['qid']} with response")
+            continue
+        torun.append(query)
+    items = []
+    for query in torun:
+        # the formatted facts of the query, by fact template, shared by all prompts for the query
+        facts_cache = {}
+        # if we have the field "pid" in the query, we use just that prompt, otherwise,
+        # if we have the field "pids" in the query, we iterate over those prompts, otherwise we use all prompts
+        # defined in the config
+        # NOTE: the field "pid" is put into the output of a processed query, which makes it possible to
+        # reprocess the output file with the same prompt
+        if "pid" in query:
+            pids = [query["pid"]]
+        elif "pids" in query:
+            pids = query["pids"]
+        else:
+            pids = prompt_idx.keys()
+        for pid in pids:
+            if debug:
+                logger.debug(f"Processing prompt {pid} for query {query['qid']}")
+            # replace facts and query variables in the prompt
+            prompt = prompt_renders[pid](query, facts_cache)
+            messages = llms.make_messages(prompt=prompt)
+            items.append((query, pid, prompt, messages))
+    todo = [(llmname, *item) for llmname in llmnames for item in items]
+    # The entries which were already finished by an earlier interrupted run with the same output file are taken from
+    # its progress file instead of querying the LLMs again. Each new entry without an error is added to the progress
+    # file as soon as it is available, and the progress file is removed once the output file has been written.
+    progress = None
+    done = {}
+    if not config['dry_run']:
+        progress = ProgressFile(config['output'] + PROGRESS_SUFFIX)
+        if config.get("restart"):
+            progress.remove()
+        done = progress.load()
+    keys = [(query["qid"], pid, llmname) for llmname, query, pid, _, _ in todo]
+    remaining = [item for item, key in zip(todo, keys) if key not in done]
+    if len(remaining) < len(todo):
+        logger.info(f"Resuming: using {len(todo) - len(remaining)} finished entries from {progress.progress_file}")
+
+    def finished(towrite):
+        if progress is not None and not towrite["error"]:
+            progress.add(towrite)
+        return towrite
+
+    try:
+        # With a concurrency of more than 1, the queries are run concurrently, since most of the time is spent
+        # waiting for the LLMs, the results are written afterwards in the original order. Otherwise each result is
+        # written as soon as we got it.
+        if config.get("concurrency") and config["concurrency"] > 1:
+            logger.info(f"Running {len(remaining)} queries with concurrency {config['concurrency']} per LLM")
+            new_results = iter(asyncio.run(run_queries_async(remaining, llms, config, on_result=finished)))
+            results = [done[key] if key in done else next(new_results) for key in keys]
+        else:
+            results = (done[key] if key in done else finished(run_query(llms, *item, config))
+                       for item, key in zip(todo, keys))
+        # the function to serialize each entry for the output file is chosen only once. For json and hjson, the entries
+        # are the elements of an array, json entries are only indented with --pretty
+        outfmt = os.path.splitext(config['output'])[1]
+        if outfmt == ".json":
+            json_opts = orjson.OPT_INDENT_2 if config.get("pretty") else 0
+            serialize = lambda entry: orjson.dumps(entry, option=json_opts)
+        elif outfmt == ".hjson":
+            import hjson
+            serialize = lambda entry: hjson.dumps(entry, indent=2).encode("utf-8")
+        else:
+            serialize = lambda entry: orjson.dumps(entry) + b"\n"
+        is_array = outfmt in (".json", ".hjson")
+        with open(config['output'], 'wb', buffering=OUTPUT_BUFSIZE) as f:
+            if is_array:
+                f.write(b"[\n")
+            # the costs are only added up here in the main thread, also when the queries are run concurrently, so no
+            # locking is needed
+            for towrite in results:
+                cost = towrite["cost"]
+                total_cost += cost
+                cost_per_llm[towrite["llm"]] += cost
+                if towrite["error"] and not config['dry_run']:
+                    n_llm_errors += 1
+                # the elements of a json or hjson array are separated by commas
+                if is_array and n_outputs:
+                    f.write(b",\n")
+                n_outputs += 1
+                f.write(serialize(towrite))
+            if is_array:
+                f.write(b"\n]\n")
+    finally:
+        if progress is not None:
+            progress.close()
+    if progress is not None:
+        progress.remove()
 
     logger.info(f"Wrote {n_outputs} entries to {config['output']}, {n_llm_errors} LLM errors")
     logger.info(f"Total cost: {total_cost}")
     logger.info(f"Cost per LLM:")
     for llmname, cost in cost_per_llm.items():
         logger.info(f"{llmname}: {cost}")
+    if config.get("response_cache") is not None:
+        cache = config["response_cache"]
+        logger.info(f"LLM response cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
 
 
 def main():
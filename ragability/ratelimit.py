@@ -0,0 +1,36 @@
+"""
+Module for limiting the rate at which queries are sent to an LLM provider.
+"""
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    Limit the number of queries per minute by spacing them evenly: each call to acquire reserves the next free slot
+    and waits until it has come. The limiter can be shared by several threads, e.g. all the threads which query
+    LLMs of the same provider.
+    """
+
+    def __init__(self, qpm: float):
+        """
+        Create the rate limiter.
+
+        :param qpm: the maximum number of queries per minute
+        """
+        if qpm <= 0:
+            raise ValueError(f"Error: the number of queries per minute must be positive, not {qpm}")
+        self.interval = 60.0 / qpm
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until the next query may be sent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,52 @@
+"""
+Tests for the progress file used to resume interrupted ragability_query runs.
+"""
+import orjson
+from ragability.progress import ProgressFile
+
+
+def make_entry(qid):
+    return {"qid": qid, "pid": "p1", "llm": "a/b", "response": f"response {qid}", "error": "", "cost": 0.1}
+
+
+def test_progress_roundtrip(tmp_path):
+    progress_file = str(tmp_path / "out.jsonl.progress.jsonl")
+    progress = ProgressFile(progress_file)
+    assert progress.load() == {}
+    progress.add(make_entry("q1"))
+    progress.add(make_entry("q2"))
+    progress.close()
+    done = ProgressFile(progress_file).load()
+    assert done == {("q1", "p1", "a/b"): make_entry("q1"), ("q2", "p1", "a/b"): make_entry("q2")}
+    ProgressFile(progress_file).remove()
+    assert not (tmp_path / "out.jsonl.progress.jsonl").exists()
+
+
+def test_progress_resume_after_truncated_line(tmp_path):
+    progress_file = str(tmp_path / "out.jsonl.progress.jsonl")
+    # an earlier run was killed while writing the entry for q2
+    with open(progress_file, "wb") as f:
+        f.write(orjson.dumps(make_entry("q1")) + b"\n")
+        f.write(orjson.dumps(make_entry("q2"))[:20])
+    progress = ProgressFile(progress_file)
+    done = progress.load()
+    assert list(done) == [("q1", "p1", "a/b")]
+    # the resumed run finishes q2 and q3, which must not be merged with the incomplete line
+    progress.add(make_entry("q2"))
+    progress.add(make_entry("q3"))
+    progress.close()
+    done = ProgressFile(progress_file).load()
+    assert list(done) == [("q1", "p1", "a/b"), ("q2", "p1", "a/b"), ("q3", "p1", "a/b")]
+    assert done[("q2", "p1", "a/b")] == make_entry("q2")
+
+
+def test_progress_add_without_load_after_truncated_line(tmp_path):
+    progress_file = str(tmp_path / "out.jsonl.progress.jsonl")
+    with open(progress_file, "wb") as f:
+        f.write(orjson.dumps(make_entry("q1")) + b"\n")
+        f.write(orjson.dumps(make_entry("q2"))[:20])
+    progress = ProgressFile(progress_file)
+    progress.add(make_entry("q3"))
+    progress.close()
+    done = ProgressFile(progress_file).load()
+    assert list(done) == [("q1", "p1", "a/b"), ("q3", "p1", "a/b")]